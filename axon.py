@@ -0,0 +1,186 @@
+import marshal
+import multiprocessing
+import threading
+
+import nationstates
+import synapse
+from backbrain import BackBrain, codes
+from latency import Trace, trace, tracer
+
+# Runs the backbrain in a process of its own, so gateway bursts, cogs and the dbh worker never share its GIL.
+# Commands and responses cross a pipe as marshal frames - the same primitive tuples as ever, plus their trace stamps.
+# time.monotonic() is one clock machine-wide, so stamps taken on either side of the pipe still line up.
+#   SCARAB_BACKBRAIN=process python scarab.py
+#
+# Every frame is a tuple starting with one of these:
+MESSAGE = 0 # (MESSAGE, item, stamps): a command on the way in, a response on the way out
+TRACE = 1 # (TRACE, kind, stamps): a command the backbrain finished with, for our tracer
+STATS = 2 # (STATS, n) asks for the backbrain's queue stats, (STATS, n, stats) answers request number n
+
+
+class Axon:
+    """
+    One end of the pipe. send() is safe to call from any thread; only one thread may recv().
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, *frame):
+        data = marshal.dumps(frame) # Raises ValueError on anything but primitives, before we touch the pipe
+        with self.lock:
+            self.conn.send_bytes(data)
+
+    def recv(self):
+        return marshal.loads(self.conn.recv_bytes())
+
+
+class Commands:
+    """
+    Our side of the backbrain's command queue: put() ships the command straight over the pipe,
+    where it lands in the backbrain's own synapse.CommandQueue.
+    """
+
+    def __init__(self, axon):
+        self.axon = axon
+        self.lock = threading.Lock()
+        self.sequence = 0 # Number of the last STATS request
+        self.waiting = {} # STATS request number -> [threading.Event, answer or None], while someone waits on it
+
+    def put(self, item):
+        item = trace(item, "cmd_sent")
+        self.axon.send(MESSAGE, tuple(item), item.stamps)
+
+    def stats(self, timeout=1.0):
+        """
+        Queue stats of the backbrain's CommandQueue, fetched over the pipe. Blocks for the round trip.
+        :param timeout: Seconds to wait for an answer
+        :return: As for synapse.CommandQueue.stats(), or None if the backbrain didn't answer in time
+        """
+        with self.lock:
+            self.sequence += 1
+            number = self.sequence
+            waiter = self.waiting[number] = [threading.Event(), None]
+        try:
+            self.axon.send(STATS, number)
+            waiter[0].wait(timeout)
+        except OSError: # Backbrain process is gone
+            pass
+        finally:
+            with self.lock:
+                del self.waiting[number]
+        return waiter[1]
+
+    def answered(self, number, stats):
+        # Reader side. An answer to a request that already gave up finds nobody waiting, and is dropped
+        with self.lock:
+            waiter = self.waiting.get(number)
+            if waiter:
+                waiter[1] = stats
+                waiter[0].set()
+
+    def abandon(self):
+        # Reader side: no answers are coming any more, stop everyone waiting for one
+        with self.lock:
+            for event, answer in self.waiting.values():
+                event.set()
+
+
+class Responses:
+    # The backbrain's side of the response queue. Its thread, the watcher loop and its pools all put() here
+
+    def __init__(self, axon):
+        self.axon = axon
+
+    def put(self, item):
+        item = trace(item, "resp_sent")
+        try:
+            self.axon.send(MESSAGE, tuple(item), item.stamps)
+        except OSError: # Parent is gone, e.g. while we shut down after it - nobody left to tell
+            pass
+
+
+class Relay:
+    # Stands in for the tracer in the backbrain process: finished commands are recorded back in ours
+
+    def __init__(self, axon):
+        self.axon = axon
+
+    def record(self, trace, kind):
+        self.axon.send(TRACE, kind, trace.stamps)
+
+
+class BackBrainProcess:
+    """
+    A BackBrain in a process of its own. Talk to it through .commands and .responses as you would to a
+    synapse.bridge() pair; both directions go through one pipe.
+    """
+
+    def __init__(self, headers, priorities=None, loop=None):
+        """
+        :param headers: HTTP headers for the backbrain
+        :param priorities: Command code -> priority class, e.g. backbrain.codes.priorities
+        :param loop: Loop the responses are delivered to. Defaults to the running loop.
+        """
+        self.responses = synapse.ResponseQueue(loop)
+
+        context = multiprocessing.get_context("spawn") # Forking would copy the discord client's threads and sockets mid-flight
+        ours, theirs = context.Pipe()
+        self.process = context.Process(target=_main, args=(theirs, headers, priorities, nationstates.BASE),
+                                       name="backbrain", daemon=True)
+        self.process.start()
+        theirs.close() # Only the child holds it now, so we see EOF once it's gone
+
+        self.axon = Axon(ours)
+        self.commands = Commands(self.axon)
+        self.reader = threading.Thread(target=self._read, name="axon", daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        # Responses go on to the loop, traces into our tracer, stats to whoever asked
+        while True:
+            try:
+                frame = self.axon.recv()
+            except (EOFError, OSError): # Backbrain process is gone
+                break
+            if frame[0] == MESSAGE:
+                self.responses.put(Trace(frame[1], frame[2]))
+            elif frame[0] == TRACE:
+                tracer.record(Trace((), frame[2]), frame[1])
+            elif frame[0] == STATS:
+                self.commands.answered(frame[1], frame[2])
+        self.commands.abandon()
+        self.process.join(1)
+        self.responses.put((codes.responses.STATUS, f"Backbrain process exited ({self.process.exitcode})")) # Rather than fall silent
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+        self.reader.join(timeout)
+
+
+def _main(conn, headers, priorities, base):
+    # Backbrain process. This thread only feeds the pipe into the command queue, the backbrain does the rest
+    nationstates.BASE = base # Set in the parent at runtime perhaps, not just from the environment
+    axon = Axon(conn)
+    commands = synapse.CommandQueue(priorities)
+    brain = BackBrain(headers, commands, Responses(axon), tracer=Relay(axon))
+
+    while brain.is_alive():
+        try:
+            if not conn.poll(0.5): # Come back around now and then to notice the backbrain exiting
+                continue
+            frame = axon.recv()
+        except (EOFError, OSError): # Parent is gone, and nobody is left to listen
+            commands.put((codes.commands.EXIT,))
+            break
+        if frame[0] == MESSAGE:
+            commands.put(Trace(frame[1], frame[2]))
+        elif frame[0] == STATS:
+            axon.send(STATS, frame[1], commands.stats())
+
+    brain.join()
+    conn.close()
@@ -1,8 +1,17 @@
 from threading import *
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
 from RegionClass import Region
 from RegionBlock import RegionBlock
 import nationstates
+import synapse
+from latency import Trace, trace, tracer
+from watcher import Watcher, Stream
+from roster import Roster
+from endorsements import EndoTracker
+from chooser import dump_file, TagPlan
+from updateorder import UpdateOrder
+from estimator import UpdateEstimator
 import datetime
 import time
 
@@ -14,12 +23,12 @@ class codes:
 
     class commands:
         EXIT = 0 # Request the brainstem to gracefully shut down. No arguments
-        BEGINTAG = 2 # Initiate a tag raid.
+        BEGINTAG = 2 # Initiate a tag raid. Optional arg: True for minor update
         ENDTAG = 4 # Terminate the tag raid.
-        GETTARG = 6 # Get a target. 1 arg: endorsements
-        SKIPTARG = 8 # Skip the target, if any.
-        OVERRIDETARG = 10 # Override the target with a custom target. 1 arg: target
-        FETCHTRIGGER = 12 # Request a trigger for a target. 2 args: First, time delay. Second, target, or None. If none, default to last supplied target. 
+        GETTARG = 6 # Get a target: the next one in the plan after a hit, or the first one. Expects: 11, or 9 if none are left
+        SKIPTARG = 8 # Skip the target, if any, for the next one in the plan we can still make. Expects: 11, or 9
+        OVERRIDETARG = 10 # Override the target with a custom target, the plan carrying on after it. 1 arg: target. Expects: 11, or 9
+        FETCHTRIGGER = 12 # Request a trigger for a target. 2 args: First, time delay. Second, target, or None. If none, default to last supplied target. Expects: 11, or 9
 
         # These three are all different ways to watch a trigger - immediately, after a dynamic delay, or after a fixed delay. This allows flexibility in the triggering logic.
         RAWWATCHTRIGGER = 14 # Watch the specified trigger, or last supplied trigger if none. Expects: 3 on trigger update. 
@@ -29,40 +38,68 @@ class codes:
         UNTRACK = 20 # Stop tracking a target for hit status
         POINT = 22 # Inform the brainstem of an attempt at point
         PING = 24 # Request a heartbeat. One arg: time recieved
-        QUERY = 26 # Perform an arbitrary query - in case we need to expand functionality
 
-        REFRESHREGIONS = 28 # Refresh the regions list
+        REFRESHREGIONS = 28 # Refresh the regions list (reload update order from the current dump)
 
-        NEWUPDATER = 30
-        GONEUPDATER = 32
-        ADDROLLCALL = 34 # Add someone to roll call
-        ROLLCALL = 36 # Get roll call
-        INCUPD = 38 # Increment updaters by one, for some reason
+        NEWUPDATER = 30 # Someone is here to update. 2 args: discord id, their verified nation or None
+        GONEUPDATER = 32 # Someone is no longer here. 1 arg: discord id
+        ROLLCALL = 36 # Get roll call. Expects: 29
+        INCUPD = 38 # Increment updaters by one, for some reason. Expects: 27
         DECUPD = 40 # Dec "
 
-        VERIFY = 42 # Send a code and nation name to the backbrain to verify
+        VERIFY = 42 # Send a code and nation name to the backbrain to verify. 5 args: message id, author id, author name, nation, code
 
         INITUPDATERS = 44 # Send a static # of updaters, particularly at boot-time
         MANUALGO = 46 # For testing
 
+        UPDATED = 48 # Internal: a watched region updated. 2 args: region, new last update time
+        VERIFIED = 50 # Internal: a verification finished. 5 args: message id, author id, author name, nation, True/False/exception
+        POINTCHECKED = 52 # Internal: a point check finished. 3 args: nation, message id, ping_point status or exception
+        ROSTER = 54 # Cache WA membership and jump point residency ahead of update. 1 arg: tuple of further nations, e.g. verified updaters
+        ROSTERED = 56 # Internal: the roster refresh finished. 1 arg: nations cached, or exception
+        ENDORSED = 58 # Internal: the point's endorsements were polled. 4 args: point, endorsing nations, WA member, region
+
     class responses:
         ABORT = 1 # Inform the parent process there has been a fatal error. 1 argument: None, or string containing error information
         GO = 3 # Inform the parent process the trigger conditions have been met. Parent process should send a GO signal.
         SKIPTARG = 5 # Inform the parent process the target should be skipped, usually due to unforeseen timing issues (e.g. target has updated before TIMEDTRIGGER delay)
         HOLD = 7 # Inform the parent process the target has delayed in updating longer than expected
         EXHAUSTED = 9 # Inform the parent process a target cannot be found within the allowed parameters. 1 arg: error string
-        TARGET = 11 # Provide the parent process with a target to aim for
+        TARGET = 11 # Provide the parent process with a target to aim for. 4 args: target, trigger, seconds from trigger to target, hits left in the plan
         HIT = 13 # Inform the parent process the registered point has been identified as delegate
         MISS = 15 # Inform the parent process the registered point has NOT been identified as delegate, despite updating
         ACKNOWLEDGE = 17 # Blanket acknowledgement without further data
         PONG = 19 # Respond to a heartbeat request
-        ANSWER = 21 # Respond to an arbitrary query
         STATUS = 23 # Inform the bot of a status effect that may impact operations, or otherwise a message that should be passed along to the humans in the discord
         SETPOINT = 25 # Inform the discord of a decision on who is point
         UPDATERS = 27 # Inform the CC how many updaters we have. Endos is this -1
-        ROLLCALLED = 29 # Inform the CC of what our roll call is
-        VERIFICATION = 31 # Inform whether or not a verification for the nation named succeeded
+        ROLLCALLED = 29 # Inform the CC of what our roll call is. 1 arg: (discord id, verified nation or None) of everyone here
+        VERIFICATION = 31 # Inform whether or not a verification for the nation named succeeded. 5 args: author name, nation, success, message id, author id
         DELETE = 33 # Delete a given message. Used to erase duplicate or invalid points. 
+        ENDOS = 35 # Inform the CC of the point's endorsements, whenever they change. 3 args: point, endorsement count, nations of present updaters yet to endorse
+
+    # Names of the codes, e.g. for latency reports
+    commandNames = {code: name for name, code in vars(commands).items() if not name.startswith("_")}
+    responseNames = {code: name for name, code in vars(responses).items() if not name.startswith("_")}
+
+    # Priority class of each command (synapse.CRITICAL first). Anything not listed is synapse.ROUTINE
+    priorities = {
+        commands.POINT: synapse.CRITICAL,
+        commands.POINTCHECKED: synapse.CRITICAL,
+        commands.MANUALGO: synapse.CRITICAL,
+        commands.UPDATED: synapse.CRITICAL,
+        commands.GETTARG: synapse.CRITICAL,
+        commands.SKIPTARG: synapse.CRITICAL,
+        commands.OVERRIDETARG: synapse.CRITICAL,
+        commands.FETCHTRIGGER: synapse.CRITICAL,
+        commands.RAWWATCHTRIGGER: synapse.CRITICAL,
+        commands.WATCHTRIGGER: synapse.CRITICAL,
+        commands.TIMEDTRIGGER: synapse.CRITICAL,
+        commands.UNTRACK: synapse.CRITICAL,
+        commands.BEGINTAG: synapse.TAG,
+        commands.ENDTAG: synapse.TAG,
+        commands.VERIFY: synapse.BULK,
+    }
 
 class states:
     # Out of update:
@@ -77,7 +114,7 @@ class states:
 # I may or may not have stolen this name from the Scythe triology. Fight me. 
 # Supply a command queue and a response queue
 class BackBrain(Thread): #Inherit multithreading
-    def __init__(self,headers,commands,responses,regionBlock=None,fetchRegions=False):
+    def __init__(self,headers,commands,responses,regionBlock=None,fetchRegions=False,tracer=tracer):
         Thread.__init__(self)
 
         # Thread upkeep and maintenance
@@ -86,9 +123,11 @@ class BackBrain(Thread): #Inherit multithreading
 #        print(self.headers)
         self.commands = commands #Inbound commands from frontend 
         self.responses = responses #Outbound responses to frontend
+        self.tracer = tracer # Where handled commands' latency traces go
 
         self.state = states.BOOT # Current state - e.g. tracking a target for updating
         self.command = None # Currently handled command, or None/idle if none
+        self.tick = 0.1 # How long to wait on commands while we have tag work to get back to
 
         self.regionBlock = regionBlock
 
@@ -97,29 +136,457 @@ class BackBrain(Thread): #Inherit multithreading
 
         # Targeting info
         self.triggerlen = 3 # Trig-Targ length. Starts at 3, adjusted on the fly. 
+        self.switchlen = 30 # Least time between one target and the next, so everyone can move over
+        self.baselineMargin = 600 # Seconds before the earliest predicted update that a watched region's update counts
         self.tagging = False
         self.jumppoint = "suspicious" # TODO: Allow changing this dynamically!
+        self.roster = Roster() # Who's in the WA and the jump point, so points are checked without asking NS
         self.updaters = 0 # Updaters available. Endos is this number -1 (we need a point)
+        self.present = {} # Discord id -> verified nation (nsified) or None, of everyone who is here
+        self.endos = None # Endorsements on the point, last we looked. None until we have
+        self.missing = () # Nations of present updaters not endorsing the point, last we looked
+        self.pointWA = True # Was the point in the WA, last we looked
         self.tracked = None # Currently tracked trigger (REGION CLASS)
-        self.target = None # Currently selected target (REGION CLASS)
+        self.trigger = None # Trigger picked for self.target (name)
+        self.target = None # Currently selected target (name)
+        self.targetUpdated = False # Has the target updated since we started watching the trigger?
         self.point = None # Designated point
         self.lastUpdated = "banana" # Last region we know updated
 
         self.firstUpd = -1 # First updating region
         self.lastUpd = -1 # Last updating region. If < firstUpd, then update in prog
 
+        self.isMinor = False # Tagging minor rather than major update
+        self.order = None # Update order of the current dump (UpdateOrder)
+        self.estimator = None # Tonight's update speed, fitted as regions update (UpdateEstimator)
+        self.plan = None # Targets and triggers for the rest of the update (chooser.TagPlan)
+        self.offPlan = None # Row of a target we picked ourselves, the plan carrying on after it. None when on the plan
+
+        self.running = True # Cleared by EXIT
+        # Blocking NS calls go to these, not our thread. Points get their own so they never queue behind verifications
+        self.pools = {
+            "point": ThreadPoolExecutor(max_workers=2, thread_name_prefix="backbrain-point"),
+            "verify": ThreadPoolExecutor(max_workers=4, thread_name_prefix="backbrain-verify"),
+        }
+        self.maxPending = 16 # Most blocking calls queued or running in each pool at once
+        self.pending = {pool: 0 for pool in self.pools} # Blocking calls queued or running in each pool right now
+        self.handlers = { # Command code -> handler
+            codes.commands.EXIT: self.exit,
+            codes.commands.BEGINTAG: self.beginTag,
+            codes.commands.ENDTAG: self.endTag,
+            codes.commands.GETTARG: self.getTarg,
+            codes.commands.SKIPTARG: self.skipTarg,
+            codes.commands.OVERRIDETARG: self.overrideTarg,
+            codes.commands.FETCHTRIGGER: self.fetchTrigger,
+            codes.commands.RAWWATCHTRIGGER: self.rawWatchTrigger,
+            codes.commands.WATCHTRIGGER: self.adaptiveWatchTrigger,
+            codes.commands.TIMEDTRIGGER: self.timedWatchTrigger,
+            codes.commands.UNTRACK: self.untrack,
+            codes.commands.POINT: self.registerPoint,
+            codes.commands.PING: self.ping,
+            codes.commands.REFRESHREGIONS: self.refreshRegions,
+            codes.commands.NEWUPDATER: self.newUpdater,
+            codes.commands.GONEUPDATER: self.goneUpdater,
+            codes.commands.ROLLCALL: self.rollCall,
+            codes.commands.INCUPD: self.newUpdater, # Someone we know nothing about
+            codes.commands.DECUPD: self.goneUpdater,
+            codes.commands.VERIFY: self.verify,
+            codes.commands.INITUPDATERS: self.initUpdaters,
+            codes.commands.MANUALGO: self.manualGo,
+            codes.commands.UPDATED: self.updated,
+            codes.commands.VERIFIED: self.verified,
+            codes.commands.POINTCHECKED: self.pointChecked,
+            codes.commands.ROSTER: self.refreshRoster,
+            codes.commands.ROSTERED: self.rostered,
+            codes.commands.ENDORSED: self.endorsed,
+        }
+
+        self.endoTracker = EndoTracker() # Polls the point's endorsements once we have a point
+        self.watcher = Watcher() # Polls triggers, targets and probes for us, off this thread
+        self.watcher.attach(Stream(self.watcher)) # ...or rather has NS push their updates to it, polling only as a fallback
+
         self.start()
 
     def detectUpdate(self):
-        if self.regions:
-            firstUpd = nationstates.track_region(regions[0])
-            lastUpd = nationstates.track_region(regions[1])
+        if self.regionBlock:
+            firstUpd = nationstates.track_region(self.regionBlock.first.name)
+            lastUpd = nationstates.track_region(self.regionBlock.last.name)
 
             if int(lastUpd) < int(firstUpd): #If firstUpd is larger than lastUpd, update has hit First update but not Last update - only ever happens during update
                 return True
             else:
                 return False
 
+    def loadOrder(self):
+        # (Re)load update order from the current dump, and start a fresh speed estimate on it
+        try:
+            self.order = UpdateOrder.load(dump_file())
+        except FileNotFoundError:
+            self.order, self.estimator = None, None
+            self.responses.put((codes.responses.STATUS, "No dump to predict update from - GO timing will not adapt."))
+            return
+        self.estimator = UpdateEstimator(self.order, self.isMinor)
+        self.plan = None # Planned on the old order
+
+    def predict(self, region):
+        # Predicted update time (estimator.Prediction) of a region, or None if we can't tell
+        if not self.estimator or not region:
+            return None
+        regionId = self.order.region_id(region)
+        return None if regionId is None else self.estimator.predict_id(regionId)
+
+    def expected(self, region):
+        prediction = self.predict(region)
+        return prediction.time if prediction else None
+
+    def baseline(self, region):
+        # Last update a watch on region can ignore - anything later is tonight's. Well before the earliest we expect it,
+        # so a trigger that updates before the watcher's first poll still fires. With no prediction, None: the watcher
+        # takes the baseline from its first poll, and a trigger that beats that poll is missed
+        prediction = self.predict(region)
+        return prediction.low - self.baselineMargin if prediction else None
+
+    def updateRow(self):
+        # Row of the last region we know updated, or the top of the update if we haven't seen any
+        regionId = self.order.region_id(self.lastUpdated)
+        row = None if regionId is None else self.order.row(regionId)
+        return 0 if row is None else row
+
+    def setPoint(self, nation):
+        self.point = nation
+        self.endos, self.missing, self.pointWA = None, (), True
+        self.responses.put((codes.responses.SETPOINT, nation))
+        self.endoTracker.track(nation, self.pointPolled, lambda: self.expected(self.trigger))
+
+    def pointPolled(self, endorsements):
+        # Runs on the tracker's loop - hand it over as primitives
+        self.commands.put((codes.commands.ENDORSED, endorsements.point, tuple(endorsements.endorsers), endorsements.wa, endorsements.region))
+
+    def nextTarget(self, skip=False):
+        # Move on to the next target in the plan, planning the rest of the update first if we have no plan
+        if not self.order:
+            self.loadOrder()
+            if not self.order:
+                self.responses.put((codes.responses.EXHAUSTED, "No dump to pick targets from"))
+                return
+
+        if self.plan is None or self.plan.trigger_time != self.triggerlen:
+            self.plan = TagPlan(self.order, self.isMinor, self.triggerlen, self.switchlen, self.updateRow())
+            entry = self.plan.current()
+        elif self.offPlan is not None: # The plan's current target is the first one after ours
+            entry = self.plan.replan(self.offPlan, 0) if skip else self.plan.current()
+        elif skip:
+            entry = self.plan.skip()
+        else:
+            entry = self.plan.step()
+
+        self.offPlan = None
+
+        # Update may have run past the plan while we weren't looking
+        if entry and self.updateRow() >= self.plan.triggers[self.plan.position]:
+            entry = self.plan.replan(self.updateRow(), 0 if skip else None)
+
+        if not entry:
+            self.target, self.trigger = None, None
+            self.responses.put((codes.responses.EXHAUSTED, "No targets left this update"))
+            return
+        self.target, self.trigger = entry.target.name, entry.trigger.name
+        self.responses.put((codes.responses.TARGET, self.target, self.trigger, entry.trigger_time, entry.hits))
+
+    def aimAt(self, target, triggerTime):
+        # Target a region of our own choosing, with the best trigger at least triggerTime seconds ahead of it.
+        # The plan is redone to carry on after it
+        if not self.order:
+            self.loadOrder()
+            if not self.order:
+                self.responses.put((codes.responses.EXHAUSTED, "No dump to pick a trigger from"))
+                return
+
+        regionId = self.order.region_id(target)
+        row = None if regionId is None else self.order.row(regionId)
+        if row is None:
+            self.responses.put((codes.responses.EXHAUSTED, f"No region named {target} in the dump"))
+            return
+        trigger = self.order.trigger(row, triggerTime, self.isMinor)
+        if trigger is None:
+            self.responses.put((codes.responses.EXHAUSTED, f"Nothing updates {triggerTime}s before {target}"))
+            return
+
+        self.plan = TagPlan(self.order, self.isMinor, self.triggerlen, self.switchlen, row)
+        self.offPlan = row
+        self.target, self.trigger = self.order.names[row], self.order.names[trigger]
+        times = self.order.times(self.isMinor)
+        self.responses.put((codes.responses.TARGET, self.target, self.trigger, int(times[row]) - int(times[trigger]), len(self.plan) + 1))
+
+    def watchTrigger(self, trigger=None, delay=0):
+        # Watch the trigger, GO delay seconds after it updates. The target is watched too, so we know if it beats us.
+        if trigger:
+            self.trigger = trigger
+        if not self.trigger:
+            self.responses.put((codes.responses.STATUS, "No trigger to watch!"))
+            return
+
+        self.targetUpdated = False
+        self.state = states.TRACK_TRIG
+        self.watcher.watch(self.trigger, lambda region, when: self.triggered(region, when, delay), self.expected(self.trigger), self.baseline(self.trigger))
+        if self.target:
+            self.watcher.watch(self.target, self.regionUpdated, self.expected(self.target), self.baseline(self.target))
+
+    def adaptiveDelay(self):
+        # Seconds to hold GO after the trigger, adapted to update speed. (EXPERIMENTAL AT BEST)
+        # Triggers are picked triggerlen seconds ahead by yesterday's clock; on a slow night the gap to the target
+        # stretches, and we wait out the difference. On a fast night there is nothing to win back, so GO right away.
+        trigger, target = self.predict(self.trigger), self.predict(self.target)
+        if not trigger or not target:
+            return 0
+        return max(0, (target.time - trigger.time) - self.triggerlen)
+
+    # These run on the watcher's loop, not our thread: GO goes out from right here, the state machine catches up after
+
+    def triggered(self, region, when, delay):
+        go = trace((codes.responses.GO,), "detected")
+        if callable(delay): # Adaptive - worked out now, with everything the estimator has seen until the trigger
+            delay = delay()
+        if delay <= 0:
+            self.responses.put(go)
+        else:
+            self.watcher.client.loop.call_later(delay, self.timedGo, go)
+        self.regionUpdated(region, when)
+
+    def timedGo(self, go):
+        if self.targetUpdated: # Target updated during the delay - too late now
+            self.responses.put((codes.responses.SKIPTARG,))
+        else:
+            self.responses.put(go.stamp("released"))
+
+    def regionUpdated(self, region, when):
+        if self.target and region == nationstates.nsify(self.target):
+            self.targetUpdated = True
+        self.commands.put((codes.commands.UPDATED, region, when))
+
+    # Command handlers. Each takes the command tuple, see codes.commands for what's in it
+
+    def exit(self, command): #(0,)
+        self.running = False
+        self.endoTracker.stop()
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.responses.put((codes.responses.ACKNOWLEDGE,)) # Shutdown in progress
+        self.responses.put((codes.responses.STATUS,"Shutting down")) # Inform users of system shutdown
+
+    def ping(self, command):
+        # Send the gotten time right back to it, along with the stamps of the way here so the round trip is traced
+        self.responses.put(trace((codes.responses.PONG,command[1]), stamps=getattr(command, "stamps", ())))
+
+    def newUpdater(self, command): #(30, discord id, nation or None)
+        if len(command) > 1:
+            self.present[command[1]] = nationstates.nsify(command[2]) if len(command) > 2 and command[2] else None
+        self.updaters += 1
+        self.responses.put((codes.responses.UPDATERS,self.updaters)) # How many do we have?
+
+    def goneUpdater(self, command): #(32, discord id)
+        if len(command) > 1:
+            self.present.pop(command[1], None)
+        self.updaters -= 1
+        if self.updaters < 0:
+            self.updaters = 0
+        self.responses.put((codes.responses.UPDATERS,self.updaters)) # How many do we have?
+
+    def rollCall(self, command): #(36,)
+        self.responses.put((codes.responses.ROLLCALLED, tuple(self.present.items())))
+
+    def verify(self, command): #(42, message id, author id, author name, nation, code)
+        messageId, authorId, author, nation, code = command[1:6]
+        if not self.offload("verify", nationstates.verify_nation, (nation, code, self.headers), codes.commands.VERIFIED, messageId, authorId, author, nation):
+            self.responses.put((codes.responses.STATUS, f"Too many requests in flight, {author} - try verifying again in a moment."))
+
+    def verified(self, command): #(50, message id, author id, author name, nation, result)
+        self.pending["verify"] -= 1
+        messageId, authorId, author, nation, result = command[1:6]
+        if isinstance(result, Exception):
+            print(f"Verification of {nation} failed: {result!r}")
+            result = False
+        self.responses.put((codes.responses.VERIFICATION, author, nation, bool(result), messageId, authorId))
+
+    def initUpdaters(self, command):
+        self.updaters = command[1]
+        if self.updaters > 0:
+            self.responses.put((codes.responses.UPDATERS, self.updaters))
+
+    def manualGo(self, command):
+        self.responses.put((codes.responses.GO,))
+
+    def getTarg(self, command): #(6,)
+        self.nextTarget()
+
+    def skipTarg(self, command): #(8,)
+        if self.target:
+            self.watcher.unwatch(self.target)
+        if self.trigger:
+            self.watcher.unwatch(self.trigger)
+        self.nextTarget(skip=True)
+
+    def overrideTarg(self, command): #(10, target)
+        if self.target:
+            self.watcher.unwatch(self.target)
+        if self.trigger:
+            self.watcher.unwatch(self.trigger)
+        self.aimAt(command[1], self.triggerlen)
+
+    def fetchTrigger(self, command): #(12, trigger time, target or None)
+        target = command[2] if len(command) > 2 and command[2] else self.target
+        if not target:
+            self.responses.put((codes.responses.STATUS, "No target to find a trigger for!"))
+            return
+        if self.trigger:
+            self.watcher.unwatch(self.trigger)
+        self.aimAt(target, command[1])
+
+    def rawWatchTrigger(self, command): #(14, trigger or None)
+        self.watchTrigger(command[1] if len(command) > 1 else None)
+
+    def adaptiveWatchTrigger(self, command): #(16, trigger or None)
+        self.watchTrigger(command[1] if len(command) > 1 else None, self.adaptiveDelay)
+
+    def timedWatchTrigger(self, command): #(18, delay, trigger or None)
+        self.watchTrigger(command[2] if len(command) > 2 else None, command[1])
+
+    def untrack(self, command): #(20, region or None for everything)
+        if len(command) > 1 and command[1]:
+            self.watcher.unwatch(command[1])
+        else:
+            self.watcher.clear()
+            self.state = states.IDLE
+
+    def updated(self, command): #(48, region, lastupdate)
+        region = command[1]
+        self.lastUpdated = region
+        if self.estimator:
+            regionId = self.order.region_id(region)
+            if regionId is not None:
+                self.estimator.observe_id(regionId, command[2])
+        if self.trigger and region == nationstates.nsify(self.trigger):
+            self.state = states.TRACK_TARG
+        elif self.target and region == nationstates.nsify(self.target):
+            if self.state == states.TRACK_TRIG: # Target beat the trigger, a GO now would be too late
+                self.watcher.unwatch(self.trigger)
+                self.responses.put((codes.responses.SKIPTARG,))
+            self.state = states.TRACK_POINT
+
+    def beginTag(self, command): #(2, minor?)
+        if not self.tagging:
+            self.tagging = True
+            self.isMinor = bool(command[1]) if len(command) > 1 else False
+            self.loadOrder()
+            self.responses.put((codes.responses.STATUS, "Tag raid started!"))
+        else:
+            self.responses.put((codes.responses.STATUS, "Tag raid already in progress."))
+
+    def endTag(self, command):
+        if self.tagging:
+            self.tagging = False
+            self.point = None
+            self.endoTracker.stop()
+            self.plan, self.target, self.trigger = None, None, None
+            self.watcher.clear()
+            self.responses.put((codes.responses.STATUS, "Tag raid finished."))
+        else:
+            self.responses.put((codes.responses.STATUS, "No tag raid in progress."))
+
+    def refreshRegions(self, command):
+        self.loadOrder()
+        if self.order:
+            self.responses.put((codes.responses.STATUS, f"Loaded update order for {len(self.order)} regions."))
+
+    def registerPoint(self, command): #(22, point, message id)
+        # If we have a point, smite the late one
+        if not self.tagging == True:
+            self.responses.put((codes.responses.DELETE, command[2]))
+            self.responses.put((codes.responses.STATUS, "We are not tagging :c\nType .start_tag to start a raid."))
+
+        elif self.point: 
+            self.responses.put((codes.responses.DELETE, command[2]))
+        else:
+            # TODO: Verify point!
+            point = command[1]
+
+            if "=" in point: 
+                nation = point.split("=")[-1]
+            else:
+                nation = point.split("/")[-1] 
+
+            # A point we already know is good goes straight out. Anything else is checked live - whoever posts a point
+            # we had down as outside the jump point has most likely just moved in
+            if self.roster.status(nation, self.jumppoint) == 1:
+                self.setPoint(nation)
+            elif not self.offload("point", nationstates.ping_point, (nation, self.jumppoint), codes.commands.POINTCHECKED, nation, command[2]):
+                self.responses.put((codes.responses.DELETE, command[2]))
+                self.responses.put((codes.responses.STATUS, "Too many requests in flight, post the point again in a moment."))
+
+    def pointChecked(self, command): #(52, nation, message id, status)
+        self.pending["point"] -= 1
+        nation, messageId, status = command[1:4]
+        if not isinstance(status, Exception):
+            self.roster.learn(nation, self.jumppoint, status)
+        if isinstance(status, Exception):
+            print(f"Checking point {nation} failed: {status!r}")
+            self.responses.put((codes.responses.DELETE, messageId))
+            self.responses.put((codes.responses.STATUS, f"Could not check {nation}, post the point again."))
+        elif not self.tagging or self.point: # Tag ended, or somebody else's point got in first while we were checking
+            self.responses.put((codes.responses.DELETE, messageId))
+        elif status == 1:
+            self.setPoint(nation)
+        else:
+            self.responses.put((codes.responses.DELETE, messageId))
+            if status == -1:
+                self.responses.put((codes.responses.STATUS, "Not in WA!"))
+            elif status == -2:
+                self.responses.put((codes.responses.STATUS, "Not in JP!"))
+
+    def offload(self, pool, call, args, done, *context):
+        # Run a blocking call in one of our pools. Once it finishes, (done, *context, result or exception) comes back
+        # to us as a command, so its result is handled on our thread, in priority order like everything else.
+        # The handler for done gives the pending slot back.
+        if self.pending[pool] >= self.maxPending:
+            return False
+        self.pending[pool] += 1
+
+        def finished(future):
+            if future.cancelled(): # Never ran - EXIT shut the pool down. Runs on our thread, from exit()
+                self.pending[pool] -= 1
+                return
+            exception = future.exception()
+            self.commands.put((done, *context, exception if exception else future.result()))
+
+        self.pools[pool].submit(call, *args).add_done_callback(finished)
+        return True
+
+    def endorsed(self, command): #(58, point, endorsers, wa, region)
+        point, endorsers, wa, region = command[1:5]
+        if not self.point or point != nationstates.nsify(self.point): # Stale poll of an old point
+            return
+        present = {nation for nation in self.present.values() if nation}
+        missing = tuple(sorted(present - set(endorsers) - {point}))
+        if len(endorsers) != self.endos or missing != self.missing:
+            self.endos, self.missing = len(endorsers), missing
+            self.responses.put((codes.responses.ENDOS, self.point, self.endos, missing))
+        if self.pointWA and not wa:
+            self.responses.put((codes.responses.STATUS, f"Point {self.point} is no longer in the WA!"))
+        self.pointWA = wa
+
+    def refreshRoster(self, command): #(54, nations)
+        nations = command[1] if len(command) > 1 else ()
+        if not self.offload("verify", self.roster.refresh, (self.jumppoint, nations, self.headers), codes.commands.ROSTERED):
+            self.responses.put((codes.responses.STATUS, "Too many requests in flight, try the roster again in a moment."))
+
+    def rostered(self, command): #(56, count)
+        self.pending["verify"] -= 1
+        if isinstance(command[1], Exception):
+            print(f"Roster refresh failed: {command[1]!r}")
+            self.responses.put((codes.responses.STATUS, "Could not fetch the roster, points will be checked live."))
+        else:
+            self.responses.put((codes.responses.STATUS, f"Roster cached for {command[1]} nations."))
+
     def boot(self):
         print("Initializing boot procedure")
         pass
@@ -138,11 +605,11 @@ class BackBrain(Thread): #Inherit multithreading
                 # No point 
                 if not self.point:
                     # No point running tracking
+                    pass
 
                 # TODO: Allow skip if tagging stops.
-                while True:
-                    # if endos on self.point >= 1
-                    break
+                # self.endos holds the point's real endorsements once the EndoTracker has polled them,
+                # and self.missing who is here but hasn't endorsed yet
 
                 # We are now primed to tag
 
@@ -193,88 +660,29 @@ class BackBrain(Thread): #Inherit multithreading
                     self.boot()
                     self.state = states.IDLE
 
-            else: #Override comes in from high command
-                command = self.commands.get()
-                if command[0] == codes.commands.EXIT: #(0,) 
-                    self.responses.put((codes.responses.ACKNOWLEDGE,)) # Shutdown in progress
-                    self.responses.put((codes.responses.STATUS,"Shutting down")) # Inform users of system shutdown
-                    self.commands.task_done() #Signal task completed
-                    break # Exit loop forevermore
-
-                elif command[0] == codes.commands.PING:
-                    self.responses.put((codes.responses.PONG,command[1])) #Send the gotten time right back to it
-                
-                elif command[0] == codes.commands.NEWUPDATER:
-                    self.updaters += 1
-                    self.responses.put((codes.responses.UPDATERS,self.updaters)) # How many do we have?
-
-                elif command[0] == codes.commands.GONEUPDATER:
-                    self.updaters -= 1
-                    if self.updaters < 0:
-                        self.updaters = 0
-                    self.responses.put((codes.responses.UPDATERS,self.updaters)) # How many do we have?
-
-                elif command[0] == codes.commands.VERIFY:
-                    if nationstates.verify_nation(command[2],command[3],headers=self.headers):
-                        self.responses.put((codes.responses.VERIFICATION,command[1], command[2], True))
-                    else:
-                        self.responses.put((codes.responses.VERIFICATION,command[1], command[2], False))
-
-                elif command[0] == codes.commands.INITUPDATERS:
-                    self.updaters = command[1]
-                    if self.updaters > 0:
-                        self.responses.put((codes.responses.UPDATERS, self.updaters))
-
-                elif command[0] == codes.commands.MANUALGO:
-                    self.responses.put((codes.responses.GO,))
-
-                elif command[0] == codes.commands.BEGINTAG:
-                    if not self.tagging:
-                        self.tagging = True
-                        self.responses.put((codes.responses.STATUS, "Tag raid started!"))
-                    else:
-                        self.responses.put((codes.responses.STATUS, "Tag raid already in progress."))
-
-                elif command[0] == codes.commands.ENDTAG:
-                    if self.tagging:
-                        self.tagging = False
-                        self.point = None
-                        self.responses.put((codes.responses.STATUS, "Tag raid finished."))
-                    else:
-                        self.responses.put((codes.responses.STATUS, "No tag raid in progress."))
-
-                elif command[0] == codes.commands.POINT: 
-                    # If we have a point, smite the late one
-                    if not self.tagging == True:
-                        self.responses.put((codes.responses.DELETE, command[2]))
-                        self.responses.put((codes.responses.STATUS, "We are not tagging :c\nType .start_tag to start a raid."))
-
-                    elif self.point: 
-                        self.responses.put((codes.responses.DELETE, command[2]))
-                    else:
-                        # TODO: Verify point!
-                        point = command[1]
-
-                        if "=" in point: 
-                            nation = point.split("=")[-1]
-                        else:
-                            nation = point.split("/")[-1] 
-
-                        status = nationstates.ping_point(nation,self.jumppoint)
-
-                        if status == 1:
-                            self.responses.put((codes.responses.SETPOINT, nation))
-                            self.point = nation
-                        else:
-                            self.responses.put((codes.responses.DELETE, command[2]))
-                            if status == -1:
-                                self.responses.put((codes.responses.STATUS, "Not in WA!"))
-                            elif status == -2:
-                                self.responses.put((codes.responses.STATUS, "Not in JP!"))
-
-
-                # TODO: Impliment each and every command code, one by one. 
-                # This will be painful.
-
-                self.commands.task_done() #Signal task completed
+            # Sleep until high command tells us something. While tagging we come back around every tick,
+            # otherwise there is nothing to do until a command wakes us.
+            try:
+                command = self.commands.get(timeout=self.tick if self.tagging else None)
+            except Empty:
+                continue
+
+            handler = self.handlers.get(command[0])
+            if handler:
+                try:
+                    handler(command)
+                except Exception as e:
+                    print(f"Backbrain failed to handle {command}")
+                    print(e)
+                if isinstance(command, Trace):
+                    self.tracer.record(command.stamp("handled"), codes.commandNames.get(command[0], str(command[0])))
+            else:
+                print(f"Backbrain has no handler for {command}")
+
+            # TODO: Impliment each and every command code, one by one. 
+            # This will be painful.
+
+            self.commands.task_done() #Signal task completed
+            if not self.running:
+                break # Exit loop forevermore
 
@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Benchmarks for the hot paths: target/trigger selection, the database handler, and the backbrain round trip.
+# Runs against a synthetic dump in a scratch directory and prints JSON, so runs can be saved and compared:
+#   python bench.py --output baseline.json
+#   python bench.py --regions 5000 --nations 40000 --iterations 200
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def summarize(samples, elapsed):
+    # samples: seconds per operation. elapsed: wall time for all of them (can be less than the sum when concurrent)
+    ordered = sorted(samples)
+    if not ordered:
+        return {"n": 0}
+
+    def percentile(p):
+        return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        "n": len(ordered),
+        "ops_per_s": len(ordered) / elapsed if elapsed else None,
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def timed(operation, iterations):
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        begin = time.perf_counter()
+        await operation(i)
+        samples.append(time.perf_counter() - begin)
+    return summarize(samples, time.perf_counter() - start)
+
+
+async def bench_chooser(iterations, regions, seed):
+    from chooser import chooser
+
+    rng = random.Random(seed)
+    picker = chooser(None)
+    await picker.first_region()  # Load the dump outside the timings
+    results = {
+        "select_targets": await timed(lambda i: picker.select_targets(
+            is_minor=bool(i % 2), after_region=rng.randint(1, regions), count=3), iterations),
+        "select_trigger": await timed(lambda i: picker.select_trigger(
+            rng.randint(1, regions), trigger_time=rng.randint(2, 10), is_minor=bool(i % 2)), iterations),
+        "plan": await timed(lambda i: picker.plan(is_minor=bool(i % 2)), max(iterations // 10, 1)),
+    }
+
+    plan = await picker.plan()
+    steps = []
+    start = time.perf_counter()
+    while True:
+        begin = time.perf_counter()
+        if plan.step() is None:
+            break
+        steps.append(time.perf_counter() - begin)
+    results["plan_step"] = summarize(steps, time.perf_counter() - start)
+    await picker.close()
+    return results
+
+
+async def bench_dbh(iterations):
+    from dbh import dbh
+
+    database = dbh()
+    await database.initialize()
+    row = {"org": "bench", "rank": "updater", "nation": "bench_nation", "handle": "bench", "isVerified": 1}
+
+    async def one(i):
+        begin = time.perf_counter()
+        await database.insert("Updaters", dict(row, updaterID=i))
+        return time.perf_counter() - begin
+
+    results = {"insert": await timed(lambda i: database.insert("Updaters", dict(row, updaterID=i)), iterations)}
+
+    start = time.perf_counter()  # The same inserts all in flight at once, as when a burst of events comes in
+    samples = await asyncio.gather(*(one(iterations + i) for i in range(iterations)))
+    results["insert_concurrent"] = summarize(samples, time.perf_counter() - start)
+
+    results["read"] = await timed(lambda i: database.read("Updaters", ["updaterID"], [i]), iterations)
+    database.stop()
+    database.db.close()
+    return results
+
+
+async def roundtrips(commands, responses, backbrain, iterations):
+    from backbrain import codes
+
+    async def ping(i):
+        commands.put((codes.commands.PING, i))
+        while (await responses.get())[0] != codes.responses.PONG:
+            pass
+
+    results = {"ping_roundtrip": await timed(ping, iterations)}
+    commands.put((codes.commands.EXIT,))
+    await asyncio.to_thread(backbrain.join, 5)
+    return results
+
+
+async def bench_bridge(iterations):
+    import synapse
+    from backbrain import BackBrain, codes
+
+    commands, responses = synapse.bridge(priorities=codes.priorities)
+    backbrain = BackBrain({"User-Agent": "SCARAB benchmark"}, commands, responses)
+    return await roundtrips(commands, responses, backbrain, iterations)
+
+
+async def bench_process(iterations):
+    # The same round trip with the backbrain in its own process, as with SCARAB_BACKBRAIN=process
+    import axon
+    from backbrain import codes
+
+    backbrain = axon.BackBrainProcess({"User-Agent": "SCARAB benchmark"}, codes.priorities)
+    backbrain.commands.put((codes.commands.PING, -1))  # Wait out the child starting up outside the timings
+    while (await backbrain.responses.get())[0] != codes.responses.PONG:
+        pass
+    return await roundtrips(backbrain.commands, backbrain.responses, backbrain, iterations)
+
+
+@contextlib.contextmanager
+def chatter_to_stderr():
+    # Point file descriptor 1 at stderr, so the backbrain's chatter stays out of the report - processes we start too
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, KiB elsewhere
+
+
+async def main(args):
+    import dumpdb
+    import nationstates
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.time(),
+        "regions": args.regions,
+        "iterations": args.iterations,
+        "seed": args.seed,
+        "benchmarks": {},
+    }
+
+    scratch = tempfile.mkdtemp(prefix="scarab-bench-")
+    cwd = os.getcwd()
+    try:
+        # Everything opens schema.sql, scarab.db and the dump relative to the working directory
+        shutil.copy(os.path.join(HERE, "schema.sql"), scratch)
+        os.chdir(scratch)
+
+        start = time.perf_counter()
+        dump = dumpdb.synthesize(f"data.{date.today().strftime('%m.%d.%Y')}.db", args.regions, args.nations, args.seed)
+        report["dump"] = dict(dump, seconds=time.perf_counter() - start)
+
+        if "chooser" in args.only:
+            report["benchmarks"]["chooser"] = await bench_chooser(args.iterations, args.regions, args.seed)
+        if "dbh" in args.only:
+            report["benchmarks"]["dbh"] = await bench_dbh(args.iterations)
+        if "bridge" in args.only:
+            report["benchmarks"]["bridge"] = await bench_bridge(args.iterations)
+        if "process" in args.only:
+            report["benchmarks"]["process"] = await bench_process(args.iterations)
+    finally:
+        nationstates.close()  # The session the backbrains and the watcher shared
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, HERE)
+    parser = argparse.ArgumentParser(description="Benchmark SCARAB's hot paths against a synthetic dump")
+    parser.add_argument("--regions", type=int, default=30000)
+    parser.add_argument("--nations", type=int, default=250000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", default=["chooser", "dbh", "bridge", "process"],
+                        choices=["chooser", "dbh", "bridge", "process"])
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    with chatter_to_stderr():
+        report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -1,8 +1,14 @@
+import asyncio
 from datetime import date, datetime, time, timedelta, timezone
 import os
-from typing import List, NamedTuple, Tuple, Union
+import sqlite3
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple, Union
 
 import aiosqlite
+import numpy as np
+
+from updateorder import UpdateOrder
 
 
 class Region(NamedTuple):
@@ -16,26 +22,92 @@ class TrigAndTargs(NamedTuple):
     targets: List[Tuple[Region, int]]
 
 
+class PlanEntry(NamedTuple):
+    target: Region
+    trigger: Region
+    trigger_time: int  # Seconds from the trigger updating to the target updating
+    hits: int
+
+
 def to_region_url(region: str):
     return 'https://nationstates.net/region=' + region.replace(' ', '_').lower()
 
 
+def dump_file():
+    today, yesterday = date.today().strftime('%m.%d.%Y'), (date.today() - timedelta(days=1)).strftime('%m.%d.%Y')
+    # maybe in the future have more complex data dump storage for dealing with GA night? but this will work for now
+    db_file = None
+    if os.path.exists(f'data.{today}.db'):
+        db_file = f'data.{today}.db'
+    elif os.path.exists(f'data.{yesterday}.db'):
+        db_file = f'data.{yesterday}.db'
+    if not db_file:
+        raise FileNotFoundError('No current DB dump detected')
+    return db_file
+
+
 class chooser:
     def __init__(self, bot):
         self.bot = bot
         self.headers = {"User-Agent": "SCARAB Accessing NSAPI for regional data, devved by nation=hesskin_empire"}
+        self.db = None  # Long-lived read-only connection to the current dump
+        self.db_key = None  # (path, mtime) of the dump self.db points at
+        self.index = None  # UpdateOrder arrays for the dump self.db points at
+        self.db_lock = asyncio.Lock()
+
+    def _dump_file(self):
+        return dump_file()
+
+    async def _connect_db(self) -> aiosqlite.Connection:
+        """Gets the shared connection to the current dump, opening it if a newer dump has appeared.
+
+        Dumps are never written after they are generated, so the connection is opened read-only and immutable
+        (no locking, no change detection) with the file memory-mapped. A regenerated or newer dump changes
+        the (path, mtime) key, which swaps the connection over on the next call.
+
+        Raises:
+            FileNotFoundError: If a current dump is not found.
+        """
+        db_file = self._dump_file()
+        key = (db_file, os.stat(db_file).st_mtime_ns)
+        if key != self.db_key:
+            async with self.db_lock:
+                if key != self.db_key:
+                    db = await aiosqlite.connect(Path(db_file).resolve().as_uri() + '?mode=ro&immutable=1', uri=True)
+                    db.row_factory = aiosqlite.Row
+                    await db.execute('PRAGMA mmap_size = 268435456')
+                    try:
+                        triggers = await db.execute_fetchall(UpdateOrder.TRIGGER_QUERY)
+                    except sqlite3.OperationalError:  # Dump from before the Trigger table, triggers get searched for
+                        triggers = None
+                    self.index = UpdateOrder(await db.execute_fetchall(UpdateOrder.QUERY), triggers)
+                    old, self.db, self.db_key = self.db, db, key
+                    if old:
+                        await old.close()
+        return self.db
 
-    def _connect_db(self):
-        today, yesterday = date.today().strftime('%m.%d.%Y'), (date.today() - timedelta(days=1)).strftime('%m.%d.%Y')
-        # maybe in the future have more complex data dump storage for dealing with GA night? but this will work for now
-        db_file = None
-        if os.path.exists(f'data.{today}.db'):
-            db_file = f'data.{today}.db'
-        elif os.path.exists(f'data.{yesterday}.db'):
-            db_file = f'data.{yesterday}.db'
-        if not db_file:
-            raise FileNotFoundError('No current DB dump detected')
-        return aiosqlite.connect(db_file)
+    async def _index(self) -> UpdateOrder:
+        """Gets the in-memory update order index of the current dump, (re)loading it alongside the connection."""
+        await self._connect_db()
+        return self.index
+
+    async def _region_id(self, region: Union[str | int]) -> int:
+        if isinstance(region, str):
+            index = await self._index()
+            region_id = index.region_id(region)
+            if region_id is None:
+                raise KeyError(f'No region named {region} in the current dump')
+            return region_id
+        return region
+
+    @staticmethod
+    def _region(index: UpdateOrder, row: int, is_minor: bool = False) -> Region:
+        return Region(index.names[row], datetime.fromtimestamp(float(index.times(is_minor)[row])).time())
+
+    async def close(self):
+        if self.db:
+            await self.db.close()
+            self.db, self.db_key = None, None
 
     async def first_region(self, is_minor: bool = False) -> Region:
         """Gets the first updating region on the site.
@@ -49,18 +121,8 @@ class chooser:
         Raises:
             FileNotFoundError: If a current dump is not found.
         """
-        async with self._connect_db() as db:
-            db: aiosqlite.Connection
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    f'''
-                    SELECT
-                        Name, Last{"Minor" if is_minor else "Major"}Update
-                    FROM REGION
-                    LIMIT 1
-                    ''') as cursor:
-                row = await cursor.fetchone()
-                return Region(row['Name'], datetime.fromtimestamp(row[f'Last{"Minor" if is_minor else "Major"}Update']).time())
+        index = await self._index()
+        return self._region(index, 0, is_minor)
 
     async def last_region(self, is_minor: bool = False) -> Region:
         """Gets the last updating region on the site.
@@ -74,19 +136,8 @@ class chooser:
         Raises:
             FileNotFoundError: If a current dump is not found.
         """
-        async with self._connect_db() as db:
-            db: aiosqlite.Connection
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    f'''
-                    SELECT
-                        Name, Last{"Minor" if is_minor else "Major"}Update
-                    FROM REGION
-                    ORDER BY ID DESC
-                    LIMIT 1
-                    ''') as cursor:
-                row = await cursor.fetchone()
-                return Region(row['Name'], datetime.fromtimestamp(row[f'Last{"Minor" if is_minor else "Major"}Update']).time())
+        index = await self._index()
+        return self._region(index, len(index) - 1, is_minor)
 
     async def select_trigger(self, region: Union[str | int], trigger_time: int = 4, is_minor: bool = False) -> Region:
         """Selects a trigger for the region.
@@ -101,31 +152,12 @@ class chooser:
         Returns:
             A Region NamedTuple corresponding to the best available trigger.
         """
-        async with self._connect_db() as db:
-            db: aiosqlite.Connection
-            db.row_factory = aiosqlite.Row
-            if isinstance(region, str):
-                async with db.execute(
-                        'SELECT ID FROM Region WHERE lower(Name) = ?',
-                        (region.lower().replace('_', ' '),)
-                ) as cursor:
-                    region = int((await cursor.fetchone())['ID'])
-
-            async with db.execute(
-                f'''
-                    SELECT
-                        Name, Last{"Minor" if is_minor else "Major"}Update
-                    FROM Region WHERE
-                    Last{"Minor" if is_minor else "Major"}Update <= (
-                        SELECT Last{"Minor" if is_minor else "Major"}Update FROM Region WHERE ID = ?
-                    ) - ? AND LastMinorUpdate != 0
-                    ORDER BY ID DESC
-                    LIMIT 1
-                    ''', (region, trigger_time)) as cursor:
-                row = await cursor.fetchone()
-                if not row:
-                    return await self.first_region(is_minor)
-                return Region(row['Name'], datetime.fromtimestamp(row[f'Last{"Minor" if is_minor else "Major"}Update']).time())
+        index = await self._index()
+        row = index.row(await self._region_id(region))
+        trigger = None if row is None else index.trigger(row, trigger_time, is_minor)
+        if trigger is None:
+            return await self.first_region(is_minor)
+        return self._region(index, trigger, is_minor)
 
     async def select_targets(self,
                              is_minor: bool = False,
@@ -150,46 +182,146 @@ class chooser:
         if isinstance(after_region, str) and after_region.isdigit():
             after_region = int(after_region)
 
-        async with self._connect_db() as db:
-            db: aiosqlite.Connection
-            db.row_factory = aiosqlite.Row
-            if isinstance(after_region, str):
-                async with db.execute(
-                        'SELECT ID FROM Region WHERE lower(Name) = ?',
-                        (after_region.lower().replace('_', ' '),)
-                ) as cursor:
-                    after_region = int((await cursor.fetchone())['ID'])
-
-            async with db.execute(
-                    f'''
-                    SELECT
-                        Name, Last{"Minor" if is_minor else "Major"}Update
-                    FROM Region WHERE
-                    DelegateAuth & 3 = 3 AND NOT hasPassword AND NOT DelegateVotes AND LastMinorUpdate != 0
-                    AND Last{"Minor" if is_minor else "Major"}Update > (
-                        SELECT Last{"Minor" if is_minor else "Major"}Update FROM Region WHERE ID = ?
-                    ) + ?
-                    LIMIT ?
-                    ''', (after_region, switch_time, count)) as cursor:
-                first_row = await cursor.fetchone()
-                if not first_row:
-                    last_region = await self.last_region(is_minor)
-                    trigger = await self.select_trigger(last_region.name, trigger_time, is_minor)
-                    trigger_time = (datetime.combine(date.today(), trigger.last_update_time) -
-                                    datetime.combine(date.today(), last_region.last_update_time))
-                    return TrigAndTargs(trigger, int(trigger_time.total_seconds()), [(last_region, 0)])
-                first_target_name, first_target_update = first_row['Name'], first_row[f'Last{"Minor" if is_minor else "Major"}Update']
-                targets = [(Region(first_target_name, datetime.fromtimestamp(first_target_update).time()), 0)]
-                async for row in cursor:
-                    targets.append(
-                        (Region(
-                            row['Name'],
-                            datetime.fromtimestamp(row[f'Last{"Minor" if is_minor else "Major"}Update']).time()
-                        ), int(row[f'Last{"Minor" if is_minor else "Major"}Update']) - int(first_target_update))
-                    )
-
-        trigger = await self.select_trigger(first_target_name, trigger_time, is_minor)
+        index = await self._index()
+        row = index.row(await self._region_id(after_region))
+        rows = [] if row is None else index.targets(row, switch_time, count, is_minor)
+        if not len(rows):
+            last_region = await self.last_region(is_minor)
+            trigger = await self.select_trigger(int(index.ids[-1]), trigger_time, is_minor)
+            trigger_time = (datetime.combine(date.today(), trigger.last_update_time) -
+                            datetime.combine(date.today(), last_region.last_update_time))
+            return TrigAndTargs(trigger, int(trigger_time.total_seconds()), [(last_region, 0)])
+        times = index.times(is_minor)
+        first_target_update = float(times[rows[0]])
+        targets = [(self._region(index, target, is_minor), int(times[target]) - int(first_target_update)) for target in rows]
+
+        trigger = await self.select_trigger(int(index.ids[rows[0]]), trigger_time, is_minor)
         trigger_time = (datetime.combine(date.today(), trigger.last_update_time) -
                         datetime.combine(date.today(), datetime.fromtimestamp(first_target_update).time()))
 
         return TrigAndTargs(trigger, int(trigger_time.total_seconds()), targets)
+
+    async def plan(self,
+                   is_minor: bool = False,
+                   after_region: Union[str | int] = 1,
+                   trigger_time: int = 4,
+                   switch_time: int = 30) -> 'TagPlan':
+        """Plans targets and triggers for the rest of the update.
+
+        Args:
+            is_minor: Whether or not to plan for minor. Defaults to False.
+            after_region: The region to plan from. Defaults to the first updating region.
+            trigger_time: The lowest time desired for each trigger. Defaults to 4.
+            switch_time: The minimum time desired between one target and the next. Defaults to 30.
+
+        Returns:
+            A TagPlan positioned at its first target.
+        """
+        if isinstance(after_region, str) and after_region.isdigit():
+            after_region = int(after_region)
+
+        index = await self._index()
+        row = index.row(await self._region_id(after_region))
+        return TagPlan(index, is_minor, trigger_time, switch_time, 0 if row is None else row)
+
+
+class TagPlan:
+    """A whole update's worth of targets, each with its trigger, that gets the most hits possible.
+
+    Picking the earliest target we can make and then, after each hit, the earliest one we can still make is
+    interval scheduling, and it is optimal. So planning is linking every targetable region to its successor
+    once (vectorised over the update order arrays), plus a backwards pass counting the hits left from each.
+    Moving on after a hit is then a single lookup, and re-planning from anywhere a binary search.
+    """
+
+    def __init__(self, index: UpdateOrder, is_minor: bool = False, trigger_time: int = 4, switch_time: int = 30,
+                 after_row: int = 0):
+        """Builds the plan.
+
+        Args:
+            index: Update order to plan over.
+            is_minor: Whether or not to plan for minor. Defaults to False.
+            trigger_time: The lowest time desired for each trigger. Defaults to 4.
+            switch_time: The minimum time desired between one target and the next. Defaults to 30.
+            after_row: Row to start planning after. Defaults to the first region.
+        """
+        self.index = index
+        self.is_minor = is_minor
+        self.trigger_time = trigger_time
+        self.switch_time = switch_time
+
+        self.rows, self.triggers, self.successor = index.successors(switch_time, trigger_time, is_minor)
+        self.times = index.times(is_minor)[self.rows]
+        self.prefix_max = np.maximum.accumulate(self.times) if len(self.rows) else self.times
+        self.trigger_max = np.maximum.accumulate(self.triggers) if len(self.rows) else self.triggers
+
+        # hits[i]: hits we get from the i-th candidate on, following successors. hits[n] = 0 is "done".
+        hits = [0] * (len(self.rows) + 1)
+        successor = self.successor.tolist()
+        for i in range(len(self.rows) - 1, -1, -1):
+            hits[i] = hits[successor[i]] + 1
+        self.hits = hits
+
+        self.position = len(self.rows)
+        self.replan(after_row)
+
+    def __len__(self):
+        return self.hits[self.position]
+
+    def _first_after(self, row: int, switch_time: float) -> int:
+        # Same search as UpdateOrder.successors, for a single row that needn't be targetable
+        n = len(self.rows)
+        x = self.index.times(self.is_minor)[row] + switch_time
+        if np.isnan(x):
+            return n
+        j = max(int(np.searchsorted(self.prefix_max, x, side='right')),
+                int(np.searchsorted(self.trigger_max, row, side='right')))
+        while j < n and (self.times[j] <= x or self.triggers[j] <= row):
+            j += 1
+        return j
+
+    def replan(self, after_row: int, switch_time: Optional[float] = None) -> Optional[PlanEntry]:
+        """Moves the plan to the first target that can be tagged once update is past after_row.
+
+        Args:
+            after_row: Row update is at (or will be at, once we're ready again).
+            switch_time: Time needed before the next target. Defaults to the plan's switch_time.
+
+        Returns:
+            The new current entry, or None if there is nothing left to tag.
+        """
+        self.position = self._first_after(after_row, self.switch_time if switch_time is None else switch_time)
+        return self.current()
+
+    def current(self) -> Optional[PlanEntry]:
+        return self.entry(self.position)
+
+    def entry(self, position: int) -> Optional[PlanEntry]:
+        if position >= len(self.rows):
+            return None
+        target, trigger = int(self.rows[position]), int(self.triggers[position])
+        times = self.index.times(self.is_minor)
+        return PlanEntry(chooser._region(self.index, target, self.is_minor),
+                         chooser._region(self.index, trigger, self.is_minor),
+                         int(times[target]) - int(times[trigger]),
+                         self.hits[position])
+
+    def step(self) -> Optional[PlanEntry]:
+        """Moves on to the next target after a hit. O(1)."""
+        if self.position < len(self.rows):
+            self.position = int(self.successor[self.position])
+        return self.current()
+
+    def skip(self) -> Optional[PlanEntry]:
+        """Moves on to the next target after skipping this one. Nobody has to switch, so it can come sooner than step()."""
+        if self.position >= len(self.rows):
+            return None
+        return self.replan(int(self.rows[self.position]), 0)
+
+    def entries(self) -> List[PlanEntry]:
+        """Every entry left in the plan, from the current one on."""
+        entries, position = [], self.position
+        while position < len(self.rows):
+            entries.append(self.entry(position))
+            position = int(self.successor[position])
+        return entries
@@ -1,9 +1,15 @@
 #import aiohttp
 import discord
 from discord.ext import tasks, commands
-from queue import Queue
 from backbrain import BackBrain, codes
+import synapse
+import axon
+import nationstates
+from motor import Motor
+from latency import tracer
+import asyncio
 import datetime
+import os
 import re
 
 async def MakeEmbed(title:str, prompt: str, color=0x8ee6dd):
@@ -22,13 +28,17 @@ class CorpusCallosum(commands.Cog):
             "User-Agent": "SCARAB/0.1 (devved by nation=hesskin_empire and nation=Volstrostia)"
         }
 
-        self.commands = Queue()
-        self.responses = Queue()
+        self.brainstem_task = None # Started once we know where to talk, in cog_load
+        self.motor = None # Output pipeline to self.channel, also from cog_load
         
         print("Starting Backbrain")
     
-        self.backbrain = BackBrain(self.headers, self.commands, self.responses) # Backbrain autostarts on invokation
-        self.brainstem.start()
+        if os.environ.get("SCARAB_BACKBRAIN") == "process": # Out of our GIL's way, so discord traffic can't hold up trigger detection
+            self.backbrain = axon.BackBrainProcess(self.headers, codes.priorities)
+            self.commands, self.responses = self.backbrain.commands, self.backbrain.responses
+        else:
+            self.commands, self.responses = synapse.bridge(priorities=codes.priorities) # Backbrain wakes us directly, no polling either way
+            self.backbrain = BackBrain(self.headers, self.commands, self.responses) # Backbrain autostarts on invokation
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -66,66 +76,129 @@ class CorpusCallosum(commands.Cog):
         self.guild = await self.bot.fetch_guild(1039733449805811792)
         self.tagrole = discord.utils.get(self.guild.roles, name="present")
         self.channel = await self.bot.fetch_channel(1039736266893299843)  #TODO: Rework this! Hardcoding channels is for looooosers
+        self.motor = Motor(self.channel)
+        self.motor.start()
+        self.brainstem_task = asyncio.create_task(self.brainstem())
 
 #        await self.channel.send(embed = await MakeEmbed("Backbrain is Online","Awaiting tagging commands"))
 
     async def flatline(self):
         print("Shutting down Backbrain")
         self.commands.put((codes.commands.EXIT,)) # Task the backbrain to shut down
-        self.brainstem.cancel() # Terminate brainstem loop
+        if self.brainstem_task:
+            self.brainstem_task.cancel() # Terminate brainstem loop
+        if self.motor:
+            await self.motor.stop()
+        if isinstance(self.backbrain, axon.BackBrainProcess):
+            await asyncio.to_thread(self.backbrain.join, 5) # Don't leave it behind if we're reloaded
         
-    @tasks.loop(seconds=0.01) # No idea if it will accept values < 1, but 1 second is too much variability for our needs. 
     async def brainstem(self): #So named because it's the bridge between the brain and the rest of the world
+        # Sleeps until the backbrain hands us a response, then handles it straight away
+        while True:
+            task = await self.responses.get()
+            try:
+                await self.react(task)
+            except Exception as e:
+                print(f"Brainstem failed to handle {task}")
+                print(e)
+            self.responses.task_done()
+
+    def traced(self, task):
+        # Keyword arguments for a Motor send that finishes task's latency trace
+        return {"trace": task, "kind": codes.responseNames.get(task[0], str(task[0]))}
+
+    def handled(self, task):
+        # Finish task's latency trace here, for responses that don't send anything of their own
+        tracer.record(task.stamp("handled"), codes.responseNames.get(task[0], str(task[0])))
+
+    async def react(self, task):
 #        print("We meet again")
-        while not self.responses.empty():
-            task = self.responses.get()
-            if task[0] == codes.responses.PONG: #Handle pong response
-                difference = datetime.datetime.now(tz=datetime.timezone.utc) - task[1] # Sent reply at
-                await self.channel.send(embed=await MakeEmbed("PONG",f"Round-trip time: {difference.microseconds / 1000}ms"))
+        if task[0] == codes.responses.PONG: #Handle pong response
+            difference = datetime.datetime.now(tz=datetime.timezone.utc).timestamp() - task[1] # Sent reply at
+            hops = " → ".join(f"{stage} +{(stamp - task.stamps[0][1]) * 1000:.1f}ms" for stage, stamp in task.stamps)
+            self.motor.send(embed=await MakeEmbed("PONG",f"Round-trip time: {difference * 1000:.0f}ms\n{hops}"), **self.traced(task))
 
-            elif task[0] == codes.responses.UPDATERS:
-                await self.channel.send(embed=await MakeEmbed("UPDATERS",f"Updater count: {task[1]}"))
+        elif task[0] == codes.responses.UPDATERS:
+            self.motor.send(embed=await MakeEmbed("UPDATERS",f"Updater count: {task[1]}"), **self.traced(task))
 
-            elif task[0] == codes.responses.VERIFICATION:
+        elif task[0] == codes.responses.VERIFICATION:
 #                print(task[3])
-                if task[3] == True:
-                    await self.channel.send(embed=await MakeEmbed(
-                        "Verification Succeeded",
-                        f"Nation {task[2]} has been registered as belonging to {task[1]}",
-                        color=0x4ded30
-                    ) )
-
-                else:
-                    await self.channel.send(embed=await MakeEmbed(
-                        "Verification Failed",
-                        f"Nation {task[2]} could not be confirmed as belonging to {task[1]}",
-                        color=0xd90202
-                    ) )
-            
-            elif task[0] == codes.responses.GO:
-                await self.channel.send(f"{self.tagrole.mention} **GO GO GO**", embed = await MakeEmbed(
-                    "GO GO GO",
-                    f"Now move, sucka (move!)\nNow move, sucka (move!)",
-                    color=0xE9D502
-                ))
+            if task[3] == True:
+                nation = nationstates.nsify(task[2])
+                rows = await self.bot.database.read("Updaters", ["nation"], [nation]) # Keeps its updaterID, and so its hits
+                await self.bot.database.replace("Updaters", { # Verified nations get their roster prefilled before update
+                    "updaterID": rows[0]["updaterID"] if rows else None,
+                    "nation": nation,
+                    "handle": task[1],
+                    "discord": str(task[5]),
+                    "isVerified": 1,
+                }, ["nation", "discord"]) # One row per nation and per discord user - the latest verification wins
+                self.motor.send(embed=await MakeEmbed(
+                    "Verification Succeeded",
+                    f"Nation {task[2]} has been registered as belonging to {task[1]}",
+                    color=0x4ded30
+                ), **self.traced(task))
 
-            elif task[0] == codes.responses.DELETE:
-                messageID = task[1]
-                message = await self.channel.fetch_message(messageID)
-                await message.delete()
+            else:
+                self.motor.send(embed=await MakeEmbed(
+                    "Verification Failed",
+                    f"Nation {task[2]} could not be confirmed as belonging to {task[1]}",
+                    color=0xd90202
+                ), **self.traced(task))
+        
+        elif task[0] == codes.responses.GO:
+            await self.motor.urgent(f"{self.tagrole.mention} **GO GO GO**", embed = await MakeEmbed(
+                "GO GO GO",
+                f"Now move, sucka (move!)\nNow move, sucka (move!)",
+                color=0xE9D502
+            ), **self.traced(task))
 
-            elif task[0] == codes.responses.STATUS:
-                await self.channel.send(task[1])
+        elif task[0] == codes.responses.DELETE:
+            self.motor.delete(task[1]) # Gathered up with any others and bulk deleted, no fetching
+            self.handled(task)
 
-            elif task[0] == codes.responses.SETPOINT:
-                await self.channel.send(f"{self.tagrole.mention} POINT:", embed = await MakeEmbed(
-                    "POINT",
-                    f"https://www.nationstates.net/nation={task[1]}\n" * 5,
-                    color=0xb2ffff
-                ))
+        elif task[0] == codes.responses.STATUS:
+            self.motor.status(task[1]) # Merged with any others arriving around the same time
+            self.handled(task)
 
+        elif task[0] == codes.responses.TARGET:
+            self.motor.send(embed = await MakeEmbed(
+                "TARGET",
+                f"Target: https://www.nationstates.net/region={task[1]}\n"
+                f"Trigger: https://www.nationstates.net/region={task[2]} ({task[3]}s)\n"
+                f"{task[4]} hits left in the plan",
+                color=0xb2ffff
+            ), **self.traced(task))
+
+        elif task[0] == codes.responses.ENDOS:
+            missing = ", ".join(task[3]) if task[3] else "nobody"
+            self.motor.send(embed = await MakeEmbed(
+                "ENDOS",
+                f"{task[1]} has {task[2]} endorsements\nStill to endorse: {missing}",
+            ), **self.traced(task))
+
+        elif task[0] == codes.responses.SKIPTARG: # Target updated before we could hit it - on to the next one
+            self.motor.send(embed = await MakeEmbed(
+                "SKIPPED",
+                "Target updated before GO - getting the next one",
+                color=0xd90202
+            ), **self.traced(task))
+            self.commands.put((codes.commands.GETTARG,))
+
+        elif task[0] == codes.responses.ROLLCALLED:
+            here = "\n".join(f"<@{user}>: {nation or 'unverified'}" for user, nation in task[1]) or "Nobody"
+            self.motor.send(embed = await MakeEmbed("ROLL CALL", here), **self.traced(task))
+
+        elif task[0] == codes.responses.EXHAUSTED:
+            self.motor.send(embed = await MakeEmbed("EXHAUSTED", task[1], color=0xd90202), **self.traced(task))
+
+        elif task[0] == codes.responses.SETPOINT:
+            await self.motor.urgent(f"{self.tagrole.mention} POINT:", embed = await MakeEmbed(
+                "POINT",
+                f"https://www.nationstates.net/nation={task[1]}\n" * 5,
+                color=0xb2ffff
+            ), **self.traced(task))
 
-            self.responses.task_done()
 
     @commands.command() #This is a bad idea to keep in prod, but I need it for testing
     async def go(self, ctx):
@@ -134,7 +207,30 @@ class CorpusCallosum(commands.Cog):
     @commands.command()
     async def ping(self,ctx):
 #        print(f"Registered a ping at {time.time()}")
-        self.commands.put( (codes.commands.PING,ctx.message.created_at) ) # Sent at
+        self.commands.put( (codes.commands.PING,ctx.message.created_at.timestamp()) ) # Sent at, as a plain number so it can cross to a backbrain process
+
+    @commands.command()
+    async def queues(self, ctx):
+        # How deep each class of backbrain command is queued, and how long they wait
+        classes = await asyncio.to_thread(self.commands.stats) # A round trip, if the backbrain has a process of its own
+        if classes is None:
+            await self.channel.send(embed=await MakeEmbed("QUEUES", "The backbrain didn't answer", color=0xd90202))
+            return
+        lines = [f"{name}: {stats['depth']} queued, {stats['served']} served, "
+                 f"wait {stats['mean_wait'] * 1000:.1f}ms mean / {stats['max_wait'] * 1000:.1f}ms max"
+                 for name, stats in classes.items()]
+        await self.channel.send(embed=await MakeEmbed("QUEUES", "\n".join(lines)))
+
+    @commands.command()
+    async def latency(self, ctx):
+        # p50/p99 of every traced stage, e.g. GO from detection to discord's acknowledgement. The lot goes to latency.json
+        path = await asyncio.to_thread(tracer.dump)
+        lines = [f"{stage}: {report['p50_ms']:.1f} / {report['p99_ms']:.1f}ms ({report['count']})"
+                 for stage, report in tracer.summary().items()]
+        await self.channel.send(embed=await MakeEmbed(
+            "LATENCY (p50 / p99)",
+            ("\n".join(lines) or "Nothing traced yet")[:4000] + f"\n\nFull histograms in {path}",
+        ))
 
     @commands.command(aliases=["verification"])
     async def verifyurl(self,ctx):
@@ -145,7 +241,8 @@ class CorpusCallosum(commands.Cog):
 
     @commands.command()
     async def verify(self,ctx,nation,code):
-        self.commands.put( (codes.commands.VERIFY, ctx.message.author, nation, code) )
+        author = ctx.message.author
+        self.commands.put( (codes.commands.VERIFY, ctx.message.id, author.id, str(author), nation, code) ) # Primitives only, the backbrain hands them back
 
     # MOVED FROM STAGING - we need to track endo
     @commands.command(aliases=["present"])
@@ -155,15 +252,58 @@ class CorpusCallosum(commands.Cog):
         if present not in user.roles:
             await user.add_roles(present)
 #            await ctx.send(embed=await MakeEmbed("ROLED",f"Roled: {ctx.message.author}"))
-            self.commands.put((codes.commands.NEWUPDATER, ctx.message.author)) # Send a new updater along
+            rows = await self.bot.database.read("Updaters", ["discord", "isVerified"], [str(user.id), 1])
+            nation = rows[0]["nation"] if rows else None # So we can tell whether they have endorsed the point
+            self.commands.put((codes.commands.NEWUPDATER, user.id, nation)) # Send a new updater along
         else:
             await user.remove_roles(present)
 #            await ctx.send(embed=await MakeEmbed("UNROLED",f"Unroled: {ctx.message.author}"))
-            self.commands.put((codes.commands.GONEUPDATER, ctx.message.author)) # Send a new updater along
+            self.commands.put((codes.commands.GONEUPDATER, user.id)) # Send a new updater along
 
     @commands.command(aliases=["tag","start_raid"])
     async def start_tag(self, ctx):
         self.commands.put((codes.commands.BEGINTAG,))
+        await self.prefillRoster()
+
+    @commands.command()
+    async def roster(self, ctx):
+        await self.prefillRoster()
+
+    async def prefillRoster(self):
+        # Cache WA membership and jump point residency for every verified updater, so points check instantly
+        rows = await self.bot.database.read("Updaters", ["isVerified"], [1])
+        nations = tuple({row["nation"] for row in rows if row["nation"]})
+        self.commands.put((codes.commands.ROSTER, nations))
+
+    @commands.command(aliases=["next"])
+    async def target(self, ctx):
+        self.commands.put((codes.commands.GETTARG,))
+
+    @commands.command(aliases=["skiptarg"])
+    async def skip(self, ctx):
+        self.commands.put((codes.commands.SKIPTARG,))
+
+    @commands.command(aliases=["override"])
+    async def aim(self, ctx, target, trigger: float = None):
+        # Target a region of our own choosing - with a trigger that many seconds ahead of it, if given. The plan carries on after it
+        if trigger is None:
+            self.commands.put((codes.commands.OVERRIDETARG, target))
+        else:
+            self.commands.put((codes.commands.FETCHTRIGGER, trigger, target))
+
+    @commands.command()
+    async def rollcall(self, ctx):
+        self.commands.put((codes.commands.ROLLCALL,))
+
+    @commands.command(aliases=["trigger"])
+    async def watch(self, ctx, delay: float = None):
+        # Watch the current target's trigger and GO when it updates: delay seconds after it, or adapted to update speed if no delay is given
+        if delay is None:
+            self.commands.put((codes.commands.WATCHTRIGGER,))
+        elif delay <= 0:
+            self.commands.put((codes.commands.RAWWATCHTRIGGER,))
+        else:
+            self.commands.put((codes.commands.TIMEDTRIGGER, delay))
 
     @commands.command(aliases=["end_raid","stop_raid","stop_tag"])
     async def end_tag(self, ctx):
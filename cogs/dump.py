@@ -7,6 +7,9 @@ import os
 import discord
 from discord.ext import tasks, commands
 
+import dumpdb
+import nationstates
+
 
 class dump(commands.Cog):
     def __init__(self, bot):
@@ -16,26 +19,48 @@ class dump(commands.Cog):
     @discord.app_commands.checks.has_any_role(
         "command"
     )  # Needs Update Command Role!
-    async def dump(self, ctx):
-        print('Removing old files...')
+    async def dump(self, ctx, engine: str = "v20xx"):
+        """Generates today's database. Engine is v20xx (default) or python"""
         today = date.today().strftime('%m.%d.%Y')
+        if engine.lower() in ("python", "py"):
+            await self.ingest(today)
+        else:
+            print('Generating daily V20XX database...')
+            executable = './V20XX.exe' if os.name == 'nt' else './V20XX'
+            process = await asyncio.create_subprocess_exec(executable, '-n', 'scarabbot')
+            stdout, stderr = await process.communicate()
+            if stdout:
+                print(stdout.decode())
+            if stderr:
+                print(stderr.decode(), file=sys.stderr)
+            print('Indexing region and nation names, precomputing triggers...')
+            await asyncio.to_thread(dumpdb.normalize_file, f'data.{today}.db')
+        print('Removing old files...') # Only now - the python engine refreshes from yesterday's database
         for file in glob('data.*.db'):
             if today not in file:
                 os.remove(file)
         for file in glob('regions.*.xml.gz'):
             if today not in file:
                 os.remove(file)
-        print('Generating daily V20XX database...')
-        executable = './V20XX.exe' if os.name == 'nt' else './V20XX'
-        process = await asyncio.create_subprocess_exec(executable, '-n', 'scarabbot')
-        stdout, stderr = await process.communicate()
-        if stdout:
-            print(stdout.decode())
-        if stderr:
-            print(stderr.decode(), file=sys.stderr)
         print('Database generated!')
         await ctx.reply(f'Successfully generated database for {today}!')
 
+    async def ingest(self, today):
+        # Pure-python alternative to V20XX: stream the gzipped dump straight into the database
+        source = f'regions.{today}.xml.gz'
+        if not os.path.exists(source):
+            print('Downloading daily dump...')
+            await nationstates.client().download(f'{nationstates.BASE}/pages/regions.xml.gz', source)
+        print('Fetching passworded regions...')
+        passworded = await asyncio.to_thread(nationstates.regions_by_tag, 'password')
+        previous = [file for file in sorted(glob('data.*.db'), key=os.path.getmtime) if today not in file]
+        if previous:
+            print(f'Refreshing {previous[-1]} into the daily database...')
+            await asyncio.to_thread(dumpdb.refresh, source, previous[-1], f'data.{today}.db', passworded)
+            return
+        print('Generating daily database...')
+        await asyncio.to_thread(dumpdb.ingest, source, f'data.{today}.db', passworded)
+
 
 '''
     @commands.command()
@@ -1,3 +1,6 @@
+import asyncio
+import time
+
 import discord
 from discord.ext import commands, tasks
 
@@ -30,24 +33,43 @@ class staging(commands.Cog):
     @commands.command(aliases=["rs", "silence"])
     @commands.has_any_role("command")
     async def radio_silence(self, ctx):
+        present = discord.utils.get(ctx.guild.roles, name="present")
         silence = discord.utils.get(ctx.guild.roles, name="silence")
-        for member in ctx.guild.members:
-            for role in member.roles:
-                if role.name == "present":
-                    await member.add_roles(silence)
-                    print(f"{member.name} silenced!")
-        await ctx.send("**RADIO SILENCE**")
+        members = [member for member in present.members if silence not in member.roles]
+        count, elapsed = await self.apply(members, lambda member: member.add_roles(silence))
+        await ctx.send(f"**RADIO SILENCE** ({count} silenced in {elapsed:.1f}s)")
 
     @commands.command(aliases=["ers", "end_rs", "speak"])
     @commands.has_any_role("command")
     async def end_radio_silence(self, ctx):
         silence = discord.utils.get(ctx.guild.roles, name="silence")
-        for member in ctx.guild.members:
-            for role in member.roles:
-                if role.name == silence:
-                    await member.remove_roles(silence)
-                    print(f"{member.name} may now SPEAK")
-        await ctx.send("**RADIO SILENCE IS NOW OVER**")
+        count, elapsed = await self.apply(list(silence.members), lambda member: member.remove_roles(silence))
+        await ctx.send(f"**RADIO SILENCE IS NOW OVER** ({count} may now speak, {elapsed:.1f}s)")
+
+    async def apply(self, members, change, parallel=10, attempts=5):
+        # Run a role change for each member, a few at a time, backing off when discord rate limits us.
+        # Returns (members changed, seconds taken)
+        start = time.monotonic()
+        limit = asyncio.Semaphore(parallel)
+
+        async def one(member):
+            async with limit:
+                for attempt in range(attempts):
+                    try:
+                        await change(member)
+                        return True
+                    except discord.RateLimited as e: # discord.py wouldn't wait this one out for us
+                        await asyncio.sleep(e.retry_after)
+                    except discord.HTTPException as e:
+                        if e.status != 429:
+                            print(f"Role change failed for {member.name}: {e}")
+                            return False
+                        await asyncio.sleep(2 ** attempt)
+                print(f"Gave up on {member.name} after {attempts} rate limits")
+                return False
+
+        done = await asyncio.gather(*(one(member) for member in members))
+        return sum(done), time.monotonic() - start
 
 
 async def setup(bot):
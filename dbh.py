@@ -1,8 +1,8 @@
 import asyncio
 import sqlite3
 import threading
-import uuid
-from queue import Queue
+import time
+from queue import Queue, Empty
 
 
 class dbh:
@@ -11,69 +11,207 @@ class dbh:
     Provides a clean and easy to use interface for database operations.
     Passes all operations to a worker thread, which handles them in the background,
     allowing the main thread to continue without blocking.
+    Inserts that arrive close together are group-committed: one transaction, one fsync.
     """
 
-    def __init__(self):
+    def __init__(self, batch_window=0.005, batch_size=500):
+        """
+        :param batch_window: Seconds to keep gathering queued inserts before committing them together
+        :param batch_size: Most inserts committed in one transaction. 1 turns batching off
+        """
         self.db = sqlite3.connect('scarab.db', check_same_thread=False)
         self.db.row_factory = sqlite3.Row
-        self.insert_queue = Queue()  # Queue of transactions to be inserted into the database (table, data, transaction_id)
-        self.read_queue = Queue()  # Queue of transactions to be read from the database (table, keys, transaction_id)
-        self.results_queue = Queue()  # Queue of results to be returned to the caller (transaction_id, results)
+        self.db.execute("PRAGMA journal_mode = WAL")  # Readers don't block the writer, commits append instead of rewriting
+        self.db.execute("PRAGMA synchronous = NORMAL")  # WAL is still crash-safe at NORMAL, and skips an fsync per commit
+        self.db.execute("PRAGMA cache_size = -16000")  # 16 MB page cache
+        self.db.execute("PRAGMA temp_store = MEMORY")
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.rowid_columns = {}  # Table -> name of its INTEGER PRIMARY KEY column, if any
+        self.work_queue = Queue()  # Queue of transactions for the worker (operation, table, args, future)
         self.work_stop = threading.Event()
-        self.worker_thread = threading.Thread(target=self.worker)
+        self.worker_thread = threading.Thread(target=self.worker, daemon=True)
         self.worker_thread.start()
 
     async def initialize(self):
         with open("schema.sql") as f:
             try:
-                t = threading.Thread(target=self.db.executescript, args=(f.read(),))
-                t.start()
-                while t.is_alive():
-                    await asyncio.sleep(0.1)  # nonblocking sleep until the thread is done
+                await self._submit("script", None, (f.read(),))
             except Exception as e:
                 return 1
         return 0
 
+    def stop(self):
+        """
+        Stop the worker once it has drained everything queued before this call.
+        :return:
+        """
+        self.work_stop.set()
+        self.work_queue.put(None)  # Wake the worker if it is waiting on an empty queue
+        self.worker_thread.join()
+
     def worker(self):
         """
         Long-running worker thread that handles database operations.
+        Blocks on the work queue, so it costs nothing while there is nothing to do.
         :return:
         """
+        pending = None  # Transaction pulled off the queue while gathering a batch, handled next
         while True:
-            if not threading.current_thread().is_alive():  # If the thread is dead, we die too
+            if pending is not None:
+                transaction, pending = pending, None
+            else:
+                transaction = self.work_queue.get()
+            if transaction is None:
+                self.work_queue.task_done()
+                if self.work_stop.is_set():
+                    break
+                continue
+
+            if transaction[0] == "insert" and self.batch_size > 1:
+                batch, pending = self._gather(transaction)
+                self._flush(batch)
+                for _ in batch:
+                    self.work_queue.task_done()
+                continue
+
+            operation, table, args, future = transaction
+            try:
+                result = getattr(self, f"_{operation}")(table, *args)
+            except Exception as e:
+                self._resolve(future, exception=e)
+            else:
+                self._resolve(future, result)
+            self.work_queue.task_done()
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        """
+        Hand a result back to the caller's event loop.
+        :param future: Future the caller is awaiting
+        :param result: Result to set
+        :param exception: Exception to raise in the caller instead, if any
+        :return:
+        """
+        def _set():
+            if future.done():  # Caller gave up (cancelled) in the meantime
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        future.get_loop().call_soon_threadsafe(_set)
+
+    async def _submit(self, operation, table, args):
+        """
+        Queue an operation for the worker and wait for its own result.
+        :param operation: Name of the worker-side method to run (without the leading underscore)
+        :param table: Table to operate on
+        :param args: Further arguments for the operation
+        :return: Result of the operation
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.work_queue.put((operation, table, args, future))
+        return await future
+
+    def _gather(self, first):
+        """
+        Collect inserts queued behind the first one, for up to batch_window seconds or batch_size rows.
+        Anything that isn't an insert ends the batch, so reads still see every write queued before them.
+        :param first: Insert transaction that started the batch
+        :return: (batch, transaction that ended it or None)
+        """
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            try:
+                transaction = self.work_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except Empty:
                 break
-            if self.work_stop.is_set():
-                pass
+            if transaction is None or transaction[0] != "insert":
+                return batch, transaction
+            batch.append(transaction)
+        return batch, None
+
+    def _flush(self, batch):
+        """
+        Write a batch of inserts in a single transaction and resolve each caller with its row id.
+        :param batch: Insert transactions
+        :return:
+        """
+        groups = {}  # (table, columns) -> [(values, future)], so each group is one executemany
+        for operation, table, (data,), future in batch:
+            groups.setdefault((table, tuple(data.keys())), []).append((tuple(data.values()), future))
+
+        results = []
+        try:
+            with self.db:  # Commits once at the end, rolls everything back on error
+                for (table, keys), rows in groups.items():
+                    rowids = self._insert_many(table, keys, [values for values, future in rows])
+                    results.extend(zip([future for values, future in rows], rowids))
+        except Exception:
+            # Somebody's row is bad - redo them one transaction each so only they get the error
+            for operation, table, (data,), future in batch:
+                try:
+                    self._resolve(future, self._insert(table, data))
+                except Exception as e:
+                    self._resolve(future, exception=e)
+            return
+
+        for future, rowid in results:
+            self._resolve(future, rowid)
+
+    def _insert_many(self, table, keys, rows):
+        sql = f"INSERT INTO {table} (" + ", ".join(keys) + ") VALUES(" + ", ".join(["?" for key in keys]) + ")"
+        cur = self.db.cursor()
+        if len(rows) == 1 or self._sets_rowid(table, keys):
+            rowids = []
+            for values in rows:
+                cur.execute(sql, values)
+                rowids.append(cur.lastrowid)
+            return rowids
+
+        # Without an explicit rowid, rows inserted back to back in one transaction get consecutive rowids
+        cur.executemany(sql, rows)
+        last = self.db.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def _sets_rowid(self, table, keys):
+        if table not in self.rowid_columns:
+            pk = [row for row in self.db.execute(f"PRAGMA table_info({table})") if row["pk"]]
+            if len(pk) == 1 and pk[0]["type"].upper() == "INTEGER":
+                self.rowid_columns[table] = pk[0]["name"].lower()
             else:
-                if not self.insert_queue.empty():
-                    transaction = self.insert_queue.get()
-                    table = transaction[0]
-                    data = transaction[1]
-                    transaction_id = transaction[2]
-                    keys = [":" + key for key in data.keys()]
-                    sql = f"INSERT INTO {table} (" + ", ".join(["?" for key in data.keys()]) + ") VALUES(" + ", ".join(
-                        ["?" for key in data.keys()]) + ")"
-                    cur = self.db.cursor()
-                    cur.execute(sql, tuple(data.values()))
-                    self.db.commit()
-                    self.results_queue.put((transaction_id, cur.lastrowid))
-                    self.insert_queue.task_done()
-
-                elif not self.read_queue.empty():
-                    transaction = self.read_queue.get()
-                    table = transaction[0]
-                    keys = transaction[1]
-                    values = transaction[2]
-                    transaction_id = transaction[3]
-                    sql = f"SELECT * FROM {table} WHERE " + " AND ".join([f"{key} = ?" for key in keys])
-                    cur = self.db.cursor()
-                    cur.execute(sql, tuple(values))
-                    rows = cur.fetchall()
-                    self.results_queue.put((transaction_id, rows))
-                    self.read_queue.task_done()
-
-                else:
-                    pass
+                self.rowid_columns[table] = None
+        names = {key.lower() for key in keys}
+        return bool(names & {"rowid", "oid", "_rowid_", self.rowid_columns[table]})
+
+    def _script(self, table, script):
+        self.db.executescript(script)
+
+    def _insert(self, table, data):
+        sql = f"INSERT INTO {table} (" + ", ".join(data.keys()) + ") VALUES(" + ", ".join(
+            ["?" for key in data.keys()]) + ")"
+        cur = self.db.cursor()
+        with self.db:
+            cur.execute(sql, tuple(data.values()))
+        return cur.lastrowid
+
+    def _replace(self, table, data, keys):
+        cur = self.db.cursor()
+        with self.db:  # Old rows go and the new one arrives in the same transaction
+            cur.execute(f"DELETE FROM {table} WHERE " + " OR ".join([f"{key} = ?" for key in keys]),
+                        tuple(data[key] for key in keys))
+            cur.execute(f"INSERT INTO {table} (" + ", ".join(data.keys()) + ") VALUES(" + ", ".join(
+                ["?" for key in data.keys()]) + ")", tuple(data.values()))
+        return cur.lastrowid
+
+    def _read(self, table, keys, values):
+        sql = f"SELECT * FROM {table} WHERE " + " AND ".join([f"{key} = ?" for key in keys])
+        cur = self.db.cursor()
+        cur.execute(sql, tuple(values))
+        return cur.fetchall()
 
     async def insert(self, table, data):
         """
@@ -82,17 +220,17 @@ class dbh:
         :param data: Data to insert
         :return: Row ID of the inserted row
         """
-        transaction_id = uuid.uuid4()
-        self.insert_queue.put((table, data, transaction_id))
-        while True:
-            if not self.results_queue.empty():
-                result = self.results_queue.get()
-                if result[0] == transaction_id:
-                    return result[1]
-                else:
-                    self.results_queue.put(result)
-            else:
-                await asyncio.sleep(0)  # Yield to other tasks
+        return await self._submit("insert", table, (data,))
+
+    async def replace(self, table, data, keys):
+        """
+        Insert a row in place of every row that shares a value with it in any of keys.
+        :param table: Table to insert into
+        :param data: Data to insert
+        :param keys: Columns of data that identify the rows it replaces
+        :return: Row ID of the inserted row
+        """
+        return await self._submit("replace", table, (data, keys))
 
     async def read(self, table, keys, values):
         """
@@ -102,14 +240,4 @@ class dbh:
         :param values: Values to match
         :return: Rows matching the query
         """
-        transaction_id = uuid.uuid4()
-        self.read_queue.put((table, keys, values, transaction_id))
-        while True:
-            if not self.results_queue.empty():
-                result = self.results_queue.get()
-                if result[0] == transaction_id:
-                    return result[1]
-                else:
-                    self.results_queue.put(result)
-            else:
-                await asyncio.sleep(0)
+        return await self._submit("read", table, (keys, values))
@@ -0,0 +1,14 @@
+-- What only the data.<date>.db dumps have, on top of schema.sql (see dumpdb.schema)
+CREATE TABLE IF NOT EXISTS "Trigger"
+(
+"Region" integer not null ,
+"Minor" integer not null ,
+"Length" integer not null ,
+"Trigger" integer ,
+PRIMARY KEY ("Region", "Minor", "Length")
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS "RegionNormName" ON "Region" ("NormName");
+CREATE INDEX IF NOT EXISTS "RegionMajorUpdate" ON "Region" ("LastMajorUpdate");
+CREATE INDEX IF NOT EXISTS "RegionMinorUpdate" ON "Region" ("LastMinorUpdate");
+CREATE UNIQUE INDEX IF NOT EXISTS "NationNormName" ON "Nation" ("NormName");
+CREATE INDEX IF NOT EXISTS "NationRegion" ON "Nation" ("Region");
@@ -0,0 +1,373 @@
+import gzip
+import os
+import random
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+from defusedxml.ElementTree import iterparse
+
+from nationstates import nsify
+from updateorder import UpdateOrder
+
+# Utilities for building and maintaining the daily data.<date>.db dumps that chooser reads from.
+# Everything in here is synchronous sqlite3 - run it in a thread (asyncio.to_thread) from the bot.
+
+
+def schema():
+    # Dumps get the bot's tables from schema.sql, plus their own Trigger table and indexes from dump.sql - scarab.db never sees those
+    parts = []
+    for name in ("schema.sql", "dump.sql"):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)) as f:
+            parts.append(f.read())
+    return "\n".join(parts)
+
+
+def _nsify(name):
+    return nsify(name) if name is not None else None
+
+
+def normalize(db):
+    """
+    Bring a dump up to the current schema: NormName columns filled in with nsify(), and the lookup indexes.
+    Safe to run more than once, and on dumps that predate NormName (e.g. straight out of V20XX).
+    :param db: Open sqlite3 connection to the dump
+    :return:
+    """
+    for table in ("Region", "Nation"):
+        columns = [row[1] for row in db.execute(f'PRAGMA table_info("{table}")')]
+        if columns and "NormName" not in columns:
+            db.execute(f'ALTER TABLE "{table}" ADD COLUMN "NormName" varchar')
+
+    db.create_function("nsify", 1, _nsify, deterministic=True)
+    with db:
+        db.execute('UPDATE Region SET NormName = nsify(Name) WHERE NormName IS NULL')
+        db.execute('UPDATE Nation SET NormName = nsify(Name) WHERE NormName IS NULL')
+    db.executescript(schema())  # Creates whatever indexes are missing
+
+
+def normalize_file(path):
+    db = sqlite3.connect(path)
+    try:
+        normalize(db)
+        with db:
+            build_triggers(db)
+    finally:
+        db.close()
+
+
+def build_triggers(db, lengths=UpdateOrder.TRIGGER_LENGTHS):
+    """
+    Precompute the best trigger of every targetable region, for each trigger length and both updates, into the
+    Trigger table - so picking a trigger mid-update is one lookup instead of a search. Run it inside the transaction
+    that last touched Region, once the regions are final.
+    :param db: Open sqlite3 connection to the dump, already in the current schema
+    :param lengths: Trigger lengths in whole seconds
+    :return: Number of rows written
+    """
+    index = UpdateOrder(db.execute(UpdateOrder.QUERY).fetchall())
+    targetable = np.flatnonzero((index.flags & UpdateOrder.TARGETABLE) == UpdateOrder.TARGETABLE)
+    rows = []
+    for minor in (False, True):
+        for length in lengths:
+            triggers = index.triggers(targetable, length, minor)
+            rows.extend(zip(index.ids[targetable].tolist(), [int(minor)] * len(targetable), [length] * len(targetable),
+                            [int(index.ids[trigger]) if trigger >= 0 else None for trigger in triggers.tolist()]))
+    db.execute('DELETE FROM "Trigger"')
+    db.executemany('INSERT INTO "Trigger" (Region, Minor, Length, Trigger) VALUES(?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+# Authority codes as they appear in the dump, in bit order: DelegateAuth & 3 = 3 means Executive + WA
+AUTHORITIES = "XWABCEP"
+
+REGION_COLUMNS = (
+    "ID", "Name", "NumNations", "Delegate", "DelegateVotes", "DelegateAuth", "Founder", "FounderAuth", "Factbook",
+    "Embassies", "LastUpdate", "LastMajorUpdate", "LastMinorUpdate", "hasPassword", "hasGovernor", "NormName",
+)
+NATION_COLUMNS = ("ID", "Name", "Region", "NormName")
+
+
+def authority(codes):
+    return sum(1 << AUTHORITIES.index(code) for code in set(codes or "") if code in AUTHORITIES)
+
+
+def _number(text, kind=int):
+    return kind(text) if text else None
+
+
+def _holder(text):
+    # Vacant delegate/founder seats are written as "0"
+    return None if not text or text == "0" else text
+
+
+def regions(source, passworded=()):
+    """
+    Stream regions out of a regions.xml.gz without ever holding more than one REGION element in memory.
+    :param source: Path to the gzipped dump
+    :param passworded: Normalized names of regions with a password - the dump doesn't say
+    :return: Generator of (Region row as a tuple in REGION_COLUMNS order, list of nation names)
+    """
+    passworded = set(passworded)
+    with gzip.open(source, "rb") as f:
+        root = None
+        position = 0
+        for event, elem in iterparse(f, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end" or elem.tag != "REGION":
+                continue
+
+            position += 1
+            name = elem.findtext("NAME")
+            nations = (elem.findtext("NATIONS") or "").split(":")
+            embassies = [embassy.text for embassy in elem.iterfind("EMBASSIES/EMBASSY") if embassy.text]
+            row = (
+                position,
+                name,
+                _number(elem.findtext("NUMNATIONS")),
+                _holder(elem.findtext("DELEGATE")),
+                _number(elem.findtext("DELEGATEVOTES")),
+                authority(elem.findtext("DELEGATEAUTH")),
+                _holder(elem.findtext("FOUNDER")),
+                authority(elem.findtext("FOUNDERAUTH")),
+                elem.findtext("FACTBOOK"),
+                ",".join(embassies),
+                _number(elem.findtext("LASTUPDATE"), float),
+                _number(elem.findtext("LASTMAJORUPDATE"), float),
+                _number(elem.findtext("LASTMINORUPDATE"), float),
+                int(nsify(name) in passworded),
+                int(_holder(elem.findtext("GOVERNOR")) is not None),
+                nsify(name),
+            )
+            yield row, [nation for nation in nations if nation]
+
+            elem.clear()
+            root.clear()  # Drop the finished REGION from the root too, or it keeps every region alive
+
+
+def _insert_sql(table, columns):
+    return f'INSERT INTO "{table}" (' + ", ".join(columns) + ") VALUES(" + ", ".join("?" for _ in columns) + ")"
+
+
+def ingest(source, path, passworded=(), batch=2000, progress=print):
+    """
+    Build a dump database from regions.xml.gz, in the schema.sql layout.
+    Rows are written in batches inside a single transaction, into a temporary file that replaces path at the end.
+    :param source: Path to the gzipped dump
+    :param path: Database to create, e.g. data.<date>.db
+    :param passworded: Normalized names of regions with a password
+    :param batch: Regions per executemany
+    :param progress: Called with a status line every 5000 regions and once at the end. None for silence
+    :return: {"regions": n, "nations": n, "triggers": n, "seconds": s}
+    """
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    db = sqlite3.connect(tmp)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")  # Scratch file until it is complete, nothing to recover
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(schema())
+
+        region_sql, nation_sql = _insert_sql("Region", REGION_COLUMNS), _insert_sql("Nation", NATION_COLUMNS)
+        region_rows, nation_rows = [], []
+        stats = {"regions": 0, "nations": 0}
+        start = time.perf_counter()
+
+        def flush():
+            db.executemany(region_sql, region_rows)
+            db.executemany(nation_sql, nation_rows)
+            region_rows.clear()
+            nation_rows.clear()
+
+        with db:
+            for row, nations in regions(source, passworded):
+                region_rows.append(row)
+                nation_rows.extend((i, nation, row[0], nsify(nation)) for i, nation in enumerate(nations, 1))
+                stats["regions"] += 1
+                stats["nations"] += len(nations)
+
+                if len(region_rows) >= batch:
+                    flush()
+                if progress and stats["regions"] % 5000 == 0:
+                    elapsed = time.perf_counter() - start
+                    progress(f"{stats['regions']} regions, {stats['nations']} nations "
+                             f"({stats['regions'] / elapsed:.0f} regions/s, {stats['nations'] / elapsed:.0f} nations/s)")
+            flush()
+            stats["triggers"] = build_triggers(db)
+    except BaseException:
+        db.close()
+        os.remove(tmp)
+        raise
+    db.close()
+
+    os.replace(tmp, path)
+    stats["seconds"] = time.perf_counter() - start
+    if progress:
+        progress(f"Ingested {stats['regions']} regions and {stats['nations']} nations in {stats['seconds']:.1f}s")
+    return stats
+
+
+def synthesize(path, regions=30000, nations=250000, seed=0, start=None, major=3600, minor=2400):
+    """
+    Build a made-up but realistically shaped dump database: a handful of huge feeder-like regions and a long tail of
+    small ones, update times proportional to the nations before them with a little jitter, and the usual mix of
+    passwords, delegates and executive delegacies. For benchmarks and tests, not for tagging.
+    :param path: Database to create
+    :param regions: Number of regions
+    :param nations: Approximate number of nations, spread over them
+    :param seed: Random seed, so the same arguments give the same database
+    :param start: Unix time major update starts. Defaults to the last midnight UTC
+    :param major: Seconds major update takes
+    :param minor: Seconds minor update takes
+    :return: {"regions": n, "nations": n, "triggers": n}
+    """
+    rng = random.Random(seed)
+    start = start if start is not None else time.time() // 86400 * 86400
+    sizes = [max(1, int(rng.paretovariate(1.2))) for _ in range(regions)]
+    for i in rng.sample(range(regions), min(10, regions)):  # Feeders and sinkers
+        sizes[i] = rng.randint(3000, 8000)
+    scale = nations / sum(sizes)
+    sizes = [max(1, round(size * scale)) for size in sizes]
+    total = sum(sizes)
+
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    try:
+        db.executescript(schema())
+        region_rows, nation_rows = [], []
+        done = 0
+        for i, size in enumerate(sizes, 1):
+            done += size
+            name = f"Region {i}"
+            delegate = rng.random() < 0.6
+            region_rows.append((
+                i, name, size,
+                f"nation_{i}_1" if delegate else None,
+                rng.randint(1, size) if delegate else 0,
+                authority(rng.choice(["XWABCEP", "W", "XW", "X", ""])),
+                None, authority("XABCEP"), "", "",
+                start + major * done / total + rng.gauss(0, 0.5),
+                start + major * done / total + rng.gauss(0, 0.5),
+                start + 43200 + minor * done / total + rng.gauss(0, 0.5),
+                int(rng.random() < 0.1),
+                int(rng.random() < 0.3),
+                nsify(name),
+            ))
+            nation_rows.extend((j, f"Nation {i} {j}", i, f"nation_{i}_{j}") for j in range(1, size + 1))
+        with db:
+            db.executemany(_insert_sql("Region", REGION_COLUMNS), region_rows)
+            db.executemany(_insert_sql("Nation", NATION_COLUMNS), nation_rows)
+            triggers = build_triggers(db)
+    finally:
+        db.close()
+    return {"regions": regions, "nations": total, "triggers": triggers}
+
+
+def refresh(source, previous, path, passworded=(), batch=2000, progress=print):
+    """
+    Build today's dump database by applying only what changed since the previous one.
+    Works on a copy of the previous database in a single transaction, then atomically replaces path.
+    Region IDs carry over, so deleted regions leave gaps and new regions are appended after the rest - unless a new
+    region turns up in the middle of update order, or regions swap places, in which case every region is renumbered
+    by its position in today's dump, as ingest() would have.
+    Every region's update times move on each day, so most Region rows do get rewritten; nations are only touched in
+    regions whose nations changed, and are compared as one string per region rather than loaded name by name.
+    :param source: Path to today's gzipped dump
+    :param previous: Path to the previous dump database
+    :param path: Database to create, e.g. data.<date>.db
+    :param passworded: Normalized names of regions with a password
+    :param batch: Changed regions per executemany
+    :param progress: Called with a summary line at the end. None for silence
+    :return: {"inserted": n, "updated": n, "deleted": n, "unchanged": n, "nations": regions whose nations changed, "triggers": n,
+        "renumbered": bool, "seconds": s}
+    """
+    start = time.perf_counter()
+    tmp = path + ".tmp"
+    shutil.copyfile(previous, tmp)
+
+    db = sqlite3.connect(tmp)
+    try:
+        normalize(db)
+        existing = {}  # NormName -> (ID, row without ID)
+        for row in db.execute("SELECT " + ", ".join(REGION_COLUMNS) + " FROM Region"):
+            existing[row[-1]] = (row[0], tuple(row[1:]))
+        nations = dict(db.execute(  # Region ID -> its nations' names joined with ":", as the dump lists them
+            "SELECT Region, group_concat(Name, ':') FROM (SELECT Region, Name FROM Nation ORDER BY Region, ID) GROUP BY Region"))
+
+        update_sql = 'UPDATE "Region" SET ' + ", ".join(f"{column} = ?" for column in REGION_COLUMNS[1:]) + " WHERE ID = ?"
+        region_sql, nation_sql = _insert_sql("Region", REGION_COLUMNS), _insert_sql("Nation", NATION_COLUMNS)
+        stats = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0, "nations": 0, "renumbered": False}
+        next_id = max((region_id for region_id, row in existing.values()), default=0) + 1
+        last_id = 0  # ID of the last region seen, which must keep growing for the IDs to carry over
+        positions = []  # (ID, position in today's dump) of every region, in case they have to be renumbered
+        updated, inserted, stale, moved = [], [], [], []  # Rows to write, and regions whose nations are replaced
+
+        def flush():
+            db.executemany(update_sql, updated)
+            db.executemany(region_sql, inserted)
+            db.executemany("DELETE FROM Nation WHERE Region = ?", stale)
+            updated.clear()
+            inserted.clear()
+            stale.clear()
+
+        with db:
+            for row, members in regions(source, passworded):
+                norm = row[-1]
+                if norm in existing:
+                    region_id, old = existing.pop(norm)
+                    if old != row[1:]:
+                        updated.append(row[1:] + (region_id,))
+                        stats["updated"] += 1
+                    else:
+                        stats["unchanged"] += 1
+                else:
+                    region_id = next_id
+                    next_id += 1
+                    inserted.append((region_id,) + row[1:])
+                    stats["inserted"] += 1
+                if region_id < last_id:
+                    stats["renumbered"] = True
+                last_id = region_id
+                positions.append((region_id, row[0]))
+
+                if nations.get(region_id) != (":".join(members) or None):
+                    stale.append((region_id,))
+                    moved.extend((i, nation, region_id, nsify(nation)) for i, nation in enumerate(members, 1))
+                    stats["nations"] += 1
+                if len(updated) + len(inserted) >= batch:
+                    flush()
+            flush()
+
+            for region_id, old in existing.values():  # Whatever is left wasn't in today's dump
+                db.execute("DELETE FROM Region WHERE ID = ?", (region_id,))
+                db.execute("DELETE FROM Nation WHERE Region = ?", (region_id,))
+                stats["deleted"] += 1
+            db.executemany(nation_sql, moved)  # Only now, since nations move between regions
+
+            if stats["renumbered"]:
+                # Through negative IDs, so no two regions ever share one on the way
+                db.execute("CREATE TEMP TABLE Renumber (Old integer primary key, New integer)")
+                db.executemany("INSERT INTO Renumber (Old, New) VALUES(?, ?)", positions)
+                db.execute("UPDATE Region SET ID = -(SELECT New FROM Renumber WHERE Old = Region.ID)")
+                db.execute("UPDATE Region SET ID = -ID")
+                db.execute("UPDATE Nation SET Region = (SELECT New FROM Renumber WHERE Old = Nation.Region)")
+                db.execute("DROP TABLE Renumber")
+            stats["triggers"] = build_triggers(db)
+    except BaseException:
+        db.close()
+        os.remove(tmp)
+        raise
+    db.close()
+
+    os.replace(tmp, path)
+    stats["seconds"] = time.perf_counter() - start
+    if progress:
+        progress(f"Refreshed dump: {stats['inserted']} inserted, {stats['updated']} updated, {stats['deleted']} deleted, "
+                 f"{stats['unchanged']} unchanged, nations changed in {stats['nations']} regions"
+                 f"{', renumbered' if stats['renumbered'] else ''} ({stats['seconds']:.1f}s)")
+    return stats
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from defusedxml import ElementTree as ET
+
+import nationstates
+
+# Follows who has endorsed the point during a tag. One request per poll - endorsements, WA status and region all come
+# back from a single combined-shard query - polled slowly while the trigger is far off and every couple of seconds
+# as it gets close. Runs on the NS client's loop, like the watcher.
+
+
+class Endorsements:
+    def __init__(self, point, endorsers, wa, region):
+        self.point = point
+        self.endorsers = endorsers # Nsified nations endorsing the point
+        self.wa = wa # Is the point still in the WA?
+        self.region = region # Nsified region the point is in
+
+
+class EndoTracker:
+    def __init__(self, client=None, fastest=2, slowest=15, share=4):
+        self.client = client or nationstates.client()
+        self.fastest = fastest # Least seconds between two polls
+        self.slowest = slowest # Most seconds between two polls
+        self.share = share # Polls we want in before the trigger, however far off it is
+        self.point = None
+        self.callback = None # Called with an Endorsements from the client loop after every poll
+        self.deadline = None # Returns the unix time the trigger is expected to update, or None if we don't know
+        self.task = None
+
+    # Thread-safe interface
+
+    def track(self, point, callback, deadline=None):
+        self.client.loop.call_soon_threadsafe(self._track, nationstates.nsify(point), callback, deadline)
+
+    def stop(self):
+        self.client.loop.call_soon_threadsafe(self._track, None, None, None)
+
+    # Client loop side
+
+    def _track(self, point, callback, deadline):
+        if self.task:
+            self.task.cancel()
+        self.point, self.callback, self.deadline = point, callback, deadline
+        self.task = self.client.loop.create_task(self._run()) if point else None
+
+    def interval(self):
+        # Spread a few polls over the time left before the trigger, within [fastest, slowest]. Nothing to hurry for
+        # until we know when the trigger is due - no trigger yet, or no prediction of it
+        expected = self.deadline() if self.deadline else None
+        if expected is None:
+            return self.slowest
+        return min(max((expected - time.time()) / self.share, self.fastest), self.slowest)
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.callback(await self.poll(self.point))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to fetch endorsements of {self.point}")
+                print(e)
+            await asyncio.sleep(max(self.interval() - (time.monotonic() - started), 0))
+
+    @staticmethod
+    async def poll(point):
+        r = await nationstates.fetch(
+            nationstates.api(f"nation={nationstates.nsify(point)}&q=endorsements+wa+region"))
+        content = ET.fromstring(r.text)
+        endorsers = content.findtext("ENDORSEMENTS") or ""
+        return Endorsements(
+            point,
+            frozenset(nationstates.nsify(nation) for nation in endorsers.split(",") if nation),
+            content.findtext("UNSTATUS") != "Non-member",
+            nationstates.nsify(content.findtext("REGION") or ""),
+        )
@@ -0,0 +1,99 @@
+import math
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from updateorder import UpdateOrder
+
+
+class Prediction(NamedTuple):
+    time: float  # Unix time the region is expected to update
+    low: float  # Bounds of the confidence interval around it
+    high: float
+
+
+class UpdateEstimator:
+    """Live fit of tonight's update speed.
+
+    Update time is modelled as a straight line in update work, t = a + b * x, where x is the share of all nations
+    updated once a region is done. The dump's own timestamps give the prior (yesterday's speed, shifted to today),
+    and every region we see update tonight refines it by recursive least squares with exponential forgetting,
+    so each observation is O(1) and the fit follows the server if it speeds up or slows down mid-update.
+    """
+
+    def __init__(self, index: UpdateOrder, is_minor: bool = False, forgetting: float = 0.98, z: float = 1.96,
+                 now: Optional[float] = None):
+        """Sets up the prior from the dump.
+
+        Args:
+            index: Update order of the current dump.
+            is_minor: Whether to model minor rather than major update. Defaults to False.
+            forgetting: Weight kept by older observations at each new one. Lower follows speed changes faster.
+            z: Width of the confidence interval in standard deviations. Defaults to 1.96 (95%).
+            now: Unix time to shift the dump's timestamps towards, in whole days. Defaults to the current time.
+        """
+        self.index = index
+        self.is_minor = is_minor
+        self.forgetting = forgetting
+        self.z = z
+
+        self.x = index.cumulative / max(int(index.cumulative[-1]), 1) if len(index) else index.cumulative.astype(float)
+        times = index.times(is_minor)
+        valid = ~np.isnan(times)
+        if valid.sum() >= 2:
+            b, a = np.polyfit(self.x[valid], times[valid], 1)
+            residual = times[valid] - (a + b * self.x[valid])
+            variance = float(np.var(residual)) or 1.0
+        else:
+            a, b, variance = (float(times[valid][0]) if valid.any() else 0.0), 3600.0, 1.0
+
+        days = round(((now or time.time()) - a) / 86400)
+        self.theta = (float(a) + days * 86400, float(b))
+        # Covariance of (a, b): tonight can start a few minutes off yesterday, and run +-50% faster or slower.
+        # RLS keeps it in units of the residual variance.
+        self.P = ((300.0 ** 2 / variance, 0.0), (0.0, (0.5 * float(b)) ** 2 / variance))
+        self.variance = variance  # Running estimate of the residual variance, seconds squared
+        self.observations = 0
+
+    def observe(self, row: int, when: float):
+        """Feeds in a region seen updating at unix time when. O(1)."""
+        x = float(self.x[row])
+        (p00, p01), (p10, p11) = self.P
+        a, b = self.theta
+        lam = self.forgetting
+
+        # phi = (1, x)
+        Pphi = (p00 + p01 * x, p10 + p11 * x)
+        denominator = lam + Pphi[0] + x * Pphi[1]
+        k = (Pphi[0] / denominator, Pphi[1] / denominator)
+        error = when - (a + b * x)
+
+        self.theta = (a + k[0] * error, b + k[1] * error)
+        # P = (P - k phi^T P) / lam, with phi^T P = Pphi^T since P is symmetric
+        self.P = (((p00 - k[0] * Pphi[0]) / lam, (p01 - k[0] * Pphi[1]) / lam),
+                  ((p10 - k[1] * Pphi[0]) / lam, (p11 - k[1] * Pphi[1]) / lam))
+        self.variance = lam * self.variance + (1 - lam) * error * error
+        self.observations += 1
+
+    def observe_id(self, region_id: int, when: float):
+        row = self.index.row(region_id)
+        if row is not None:
+            self.observe(row, when)
+
+    def rate(self) -> float:
+        """Current estimate of seconds per nation."""
+        return self.theta[1] / max(int(self.index.cumulative[-1]), 1)
+
+    def predict(self, row: int) -> Prediction:
+        """Predicts when the region at the given row updates."""
+        x = float(self.x[row])
+        (p00, p01), (p10, p11) = self.P
+        t = self.theta[0] + self.theta[1] * x
+        spread = self.z * math.sqrt(self.variance * (1 + p00 + (p01 + p10) * x + p11 * x * x))
+        return Prediction(t, t - spread, t + spread)
+
+    def predict_id(self, region_id: int) -> Optional[Prediction]:
+        """Predicts when the region with the given ID updates, or None if it isn't in the dump."""
+        row = self.index.row(region_id)
+        return None if row is None else self.predict(row)
@@ -0,0 +1,106 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+
+# Where the time goes between something happening and discord hearing about it.
+# Commands and responses travel as Traces: the same tuples as ever, plus monotonic timestamps of every hop they pass
+# (queued, picked up, sent...). Finished traces feed per-stage histograms in the shared tracer below.
+
+
+class Trace(tuple):
+    """A command or response tuple that carries (stage, time.monotonic()) stamps of the hops it has been through."""
+
+    def __new__(cls, item, stamps=()):
+        self = super().__new__(cls, item)
+        self.stamps = list(stamps)
+        return self
+
+    def stamp(self, stage):
+        self.stamps.append((stage, time.monotonic()))
+        return self
+
+
+def trace(item, stage=None, stamps=()):
+    """
+    Wrap a tuple into a Trace (unless it already is one) and stamp it.
+    :param item: Command or response tuple
+    :param stage: Name of the hop it is at now, or None to only wrap it
+    :param stamps: Stamps to start from, e.g. those of the command a response answers
+    :return: The Trace
+    """
+    if not isinstance(item, Trace):
+        item = Trace(item, stamps)
+    if stage:
+        item.stamp(stage)
+    return item
+
+
+class Histogram:
+    def __init__(self, keep=2048):
+        self.recent = deque(maxlen=keep) # Latest samples in seconds, for percentiles
+        self.buckets = {} # Upper bound in ms (powers of two) -> samples ever seen up to it
+        self.count = 0
+        self.longest = 0.0
+
+    def add(self, seconds):
+        self.recent.append(seconds)
+        bound = 2 ** max(math.ceil(math.log2(max(seconds * 1000, 1e-3))), 0)
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.longest = max(self.longest, seconds)
+
+    def percentile(self, p):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return 0.0
+        return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+    def report(self):
+        return {
+            "count": self.count,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.longest * 1000,
+            "buckets_ms": {str(bound): n for bound, n in sorted(self.buckets.items())},
+        }
+
+
+class Tracer:
+    def __init__(self, keep=2048):
+        self.keep = keep
+        self.histograms = {} # "KIND stage>stage" -> Histogram
+        self.lock = threading.Lock() # Traces finish on the backbrain thread and the discord loop alike
+
+    def record(self, trace, kind):
+        """
+        Add a finished trace: the time between each pair of consecutive stamps, and end to end.
+        :param trace: Trace to record
+        :param kind: What it was, e.g. "GO" - histograms are kept per kind
+        :return:
+        """
+        stamps = trace.stamps
+        if len(stamps) < 2:
+            return
+        spans = [(f"{a}>{b}", tb - ta) for (a, ta), (b, tb) in zip(stamps, stamps[1:])]
+        if len(stamps) > 2:
+            spans.append((f"{stamps[0][0]}>{stamps[-1][0]}", stamps[-1][1] - stamps[0][1]))
+        with self.lock:
+            for stage, seconds in spans:
+                key = f"{kind} {stage}"
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.keep)
+                self.histograms[key].add(seconds)
+
+    def summary(self):
+        with self.lock:
+            return {key: histogram.report() for key, histogram in sorted(self.histograms.items())}
+
+    def dump(self, path="latency.json"):
+        with open(path, "w") as f:
+            json.dump({"written": time.time(), "stages": self.summary()}, f, indent=2)
+        return path
+
+
+tracer = Tracer()
@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import sqlite3
+import time
+from collections import Counter
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+from nationstates import nsify
+
+# Stand-in for the bits of the NationStates API we use, served from a dump database. For offline development and for
+# load-testing polling and ratelimit handling at full speed without spending (or getting banned from) the real budget.
+#   python mockns.py data.10.18.2026.db --port 8081 --latency 0.05 --jitter 0.02 --failure 0.01
+#   SCARAB_NS_BASE=http://127.0.0.1:8081 python scarab.py
+#
+# Serves the nation, region, a=verify, wa=1 and regionsbytag API queries, the happenings SSE feed, and /mock/stats.
+# Every client gets the real 50 requests per 30 second window, with the same RateLimit-*/Retry-After headers.
+
+
+class Window:
+    # One client's fixed ratelimit window. Times are time.monotonic().
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.start = 0.0
+        self.used = 0
+
+    def take(self):
+        # Counts a request against the window. Returns (allowed, remaining, seconds until the window resets)
+        now = time.monotonic()
+        if now >= self.start + self.window:
+            self.start, self.used = now, 0
+        self.used += 1
+        return self.used <= self.limit, max(self.limit - self.used, 0), self.start + self.window - now
+
+
+class MockNS:
+    def __init__(self, dump, limit=50, window=30, latency=0.0, jitter=0.0, failure=0.0, wa_share=0.2, lenient=False,
+                 keepalive=10, seed=None):
+        self.limit = limit
+        self.window = window
+        self.latency = latency # Seconds added to every response
+        self.jitter = jitter # +- this much, uniformly
+        self.failure = failure # Chance of a spurious 429 on any request, as if someone else shared our IP
+        self.lenient = lenient # Accept any verification code, not just checksum(nation)
+        self.keepalive = keepalive # Seconds between SSE keepalives
+        self.random = random.Random(seed)
+
+        self.windows = {} # Client -> Window
+        self.subscribers = [] # (regions, asyncio.Queue) per open SSE stream
+        self.stats = Counter()
+        self.runner = None
+
+        self._load(dump, wa_share)
+
+    def _load(self, dump, wa_share):
+        db = sqlite3.connect(dump)
+        try:
+            self.regions = {} # Region -> [name, lastupdate, hasPassword, delegate]
+            names = {}
+            for region_id, name, lastupdate, password, delegate in db.execute(
+                    "SELECT ID, Name, coalesce(LastUpdate, max(LastMajorUpdate, LastMinorUpdate), 0), hasPassword, Delegate FROM Region"):
+                self.regions[nsify(name)] = [name, int(lastupdate), bool(password), nsify(delegate or "")]
+                names[region_id] = nsify(name)
+
+            self.nations = {} # Nation -> [name, region]
+            self.residents = {region: [] for region in self.regions} # Region -> nations, in dump order
+            for name, region_id in db.execute("SELECT Name, Region FROM Nation ORDER BY Region, ID"):
+                region = names.get(region_id)
+                if region is not None:
+                    self.nations[nsify(name)] = [name, region]
+                    self.residents[region].append(nsify(name))
+        finally:
+            db.close()
+
+        # The dump doesn't say who is in the WA. Delegates have to be; everyone else is, with probability wa_share,
+        # decided by a hash of the name so it's the same from run to run.
+        self.wa = {region[3] for region in self.regions.values() if region[3] in self.nations}
+        self.wa.update(nation for nation in self.nations if self._hash(nation) % 1000 < wa_share * 1000)
+        self.endorsements = {} # Nation -> set of endorsers. Empty unless a test hands some out
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big")
+
+    @staticmethod
+    def checksum(nation):
+        # The verification code the mock expects for a nation, in place of the one NS shows on page=verify_login
+        return hashlib.sha256(f"mockns:{nsify(nation)}".encode()).hexdigest()[:43]
+
+    # State the API reports. Subclasses (e.g. a replay) can override these.
+
+    def lastupdate(self, region):
+        return self.regions[region][1]
+
+    def updated(self, region, when=None):
+        # Marks a region as updated and tells SSE subscribers. Loop thread only.
+        region = nsify(region)
+        when = int(when if when is not None else time.time())
+        if region in self.regions:
+            self.regions[region][1] = when
+        event = f'data: {json.dumps({"str": f"%%{region}%% updated.", "time": when})}\n\n'.encode()
+        for regions, queue in self.subscribers:
+            if region in regions:
+                queue.put_nowait(event)
+
+    def move(self, nation, region):
+        # Moves a nation to another region, e.g. a point jumping in
+        nation, region = nsify(nation), nsify(region)
+        old = self.nations[nation][1]
+        self.residents[old].remove(nation)
+        self.residents[region].append(nation)
+        self.nations[nation][1] = region
+
+    # HTTP side
+
+    def app(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/cgi-bin/api.cgi", self.api)
+        app.router.add_post("/cgi-bin/api.cgi", self.api)
+        app.router.add_get("/api/{buckets}", self.happenings)
+        app.router.add_get("/mock/stats", self.report)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        # Serves from the running loop. Returns the base URL to hand to nationstates.BASE / SCARAB_NS_BASE.
+        self.runner = web.AppRunner(self.app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _seconds(self, seconds):
+        # Whole seconds like NS, unless the window is shorter than that (a sped-up replay)
+        return str(math.ceil(seconds)) if self.window >= 1 else f"{seconds:.3f}"
+
+    def _headers(self, remaining, reset):
+        return {
+            "RateLimit-Policy": f"{self.limit};w={self.window}",
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(remaining),
+            "RateLimit-Reset": self._seconds(reset),
+        }
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if request.path.startswith("/mock/"):
+            return await handler(request)
+
+        self.stats["requests"] += 1
+        if not request.headers.get("User-Agent"):
+            self.stats["403"] += 1
+            return web.Response(status=403, text="Please set a User-Agent")
+
+        client = request.remote
+        window = self.windows.setdefault(client, Window(self.limit, self.window))
+        allowed, remaining, reset = window.take()
+        headers = self._headers(remaining, reset)
+
+        delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if not allowed or self.random.random() < self.failure:
+            self.stats["429"] += 1
+            self.stats["429 injected" if allowed else "429 over limit"] += 1
+            headers["Retry-After"] = self._seconds(reset)
+            return web.Response(status=429, headers=headers, text="Too Many Requests")
+
+        response = await handler(request)
+        response.headers.update(headers)
+        self.stats[str(response.status)] += 1
+        return response
+
+    async def report(self, request):
+        return web.json_response(dict(self.stats))
+
+    @staticmethod
+    def _xml(tag, id_, fields):
+        body = "".join(f"<{key}>{escape(str(value))}</{key}>" for key, value in fields.items())
+        attribute = f' id="{escape(id_)}"' if id_ else ""
+        return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?>\n<{tag}{attribute}>{body}</{tag}>',
+                            content_type="text/xml")
+
+    async def api(self, request):
+        query = dict(request.query)
+        if request.method == "POST":
+            query.update(await request.post())
+        # NS takes shards as "q=a+b" and options as ";key=value" tacked onto it
+        q, *options = query.get("q", "").split(";")
+        shards = {shard.lower() for shard in q.replace(" ", "+").split("+") if shard}
+        options = dict(option.split("=", 1) for option in options if "=" in option)
+
+        if query.get("a") == "verify":
+            self.stats["verify"] += 1
+            nation, code = nsify(query.get("nation", "")), query.get("checksum", "")
+            ok = nation in self.nations and (code == self.checksum(nation) or (self.lenient and code))
+            return web.Response(text="1\n" if ok else "0\n")
+
+        if "nation" in query:
+            self.stats["nation"] += 1
+            nation = nsify(query["nation"])
+            if nation not in self.nations:
+                return web.Response(status=404, text="Unknown nation")
+            name, region = self.nations[nation]
+            fields = {"NAME": name}
+            if "region" in shards:
+                fields["REGION"] = self.regions[region][0]
+            if "wa" in shards:
+                fields["UNSTATUS"] = "WA Member" if nation in self.wa else "Non-member"
+            if "endorsements" in shards:
+                fields["ENDORSEMENTS"] = ",".join(sorted(self.endorsements.get(nation, ())))
+            return self._xml("NATION", nation, fields)
+
+        if "region" in query:
+            self.stats["region"] += 1
+            region = nsify(query["region"])
+            if region not in self.regions:
+                return web.Response(status=404, text="Unknown region")
+            name, _, _, delegate = self.regions[region]
+            fields = {"NAME": name}
+            if "lastupdate" in shards:
+                fields["LASTUPDATE"] = self.lastupdate(region)
+            if "nations" in shards:
+                fields["NATIONS"] = ":".join(self.residents[region])
+            if "numnations" in shards:
+                fields["NUMNATIONS"] = len(self.residents[region])
+            if "delegate" in shards:
+                fields["DELEGATE"] = delegate or 0
+            return self._xml("REGION", region, fields)
+
+        if query.get("wa") in ("1", "2"):
+            self.stats["wa"] += 1
+            return self._xml("WA", None, {"MEMBERS": ",".join(sorted(self.wa))})
+
+        if "regionsbytag" in shards:
+            self.stats["regionsbytag"] += 1
+            tags = set(options.get("tags", "").lower().split(","))
+            # Only passwords are known from the dump, any other tag matches nothing
+            matches = [name for name, _, password, _ in self.regions.values() if password] if "password" in tags else []
+            return self._xml("WORLD", None, {"REGIONS": ",".join(matches)})
+
+        return web.Response(status=400, text="Unsupported query")
+
+    async def happenings(self, request):
+        # Happenings SSE feed, region buckets only: /api/region:a+region:b
+        self.stats["sse"] += 1
+        regions = {bucket.split(":", 1)[1] for bucket in request.match_info["buckets"].split("+")
+                   if bucket.startswith("region:")}
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        queue = asyncio.Queue()
+        subscriber = (regions, queue)
+        self.subscribers.append(subscriber)
+        try:
+            await response.prepare(request)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    event = b": keepalive\n\n"
+                await response.write(event)
+        except ConnectionResetError: # Client hung up, e.g. to follow other regions
+            pass
+        finally:
+            self.subscribers.remove(subscriber)
+        return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a dump database as a stand-in NationStates API")
+    parser.add_argument("dump", help="Dump database to serve, e.g. data.10.18.2026.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--limit", type=int, default=50, help="Requests per window")
+    parser.add_argument("--window", type=int, default=30, help="Ratelimit window, seconds")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency varies by +- this much")
+    parser.add_argument("--failure", type=float, default=0.0, help="Chance of a spurious 429 per request")
+    parser.add_argument("--wa-share", type=float, default=0.2, help="Share of non-delegates in the WA")
+    parser.add_argument("--lenient", action="store_true", help="Accept any verification code")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    mock = MockNS(args.dump, args.limit, args.window, args.latency, args.jitter, args.failure, args.wa_share,
+                  args.lenient, seed=args.seed)
+    print(f"Serving {len(mock.regions)} regions and {len(mock.nations)} nations on http://{args.host}:{args.port}")
+    web.run_app(mock.app(), host=args.host, port=args.port, print=None)
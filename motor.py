@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+from latency import tracer
+
+# The output side of the brainstem: everything the backbrain has to say goes out to discord through here.
+# GO and friends take the fast lane and go out the moment they arrive - only discord itself can make them wait.
+# Everything else queues in the slow lane, which never spends the last few slots of a rate limit bucket so the fast
+# lane always has one to hand. STATUS lines arriving close together are merged into one embed, and deletions into one
+# bulk delete.
+
+
+class Bucket:
+    # One of the channel's discord rate limit buckets, counted on our side from the limits discord documents, so the
+    # slow lane can back off before discord makes anyone wait. If discord answers 429 anyway (our count was off, or
+    # the limits changed), the Retry-After it gives holds the whole bucket until then.
+
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.sent = deque() # time.monotonic() of each call still inside the window
+        self.held = 0 # time.monotonic() a 429 told us to wait until
+
+    def delay(self, reserve=0):
+        # Seconds until a call fits, leaving reserve calls of the window untouched
+        now = time.monotonic()
+        if self.held > now:
+            return self.held - now
+        while self.sent and now - self.sent[0] >= self.per:
+            self.sent.popleft()
+        allowed = max(self.limit - reserve, 1)
+        if len(self.sent) < allowed:
+            return 0
+        return self.sent[len(self.sent) - allowed] + self.per - now
+
+    def hold(self, seconds):
+        # Discord said 429: nothing more on this bucket for seconds
+        self.held = max(self.held, time.monotonic() + seconds)
+
+    def spend(self):
+        # Count a call that didn't wait for us
+        self.sent.append(time.monotonic())
+
+    async def acquire(self, reserve=0):
+        while (delay := self.delay(reserve)) > 0:
+            await asyncio.sleep(delay)
+        self.spend()
+
+
+class Motor:
+    def __init__(self, channel, window=0.3, reserve=1, retries=3, color=0x8ee6dd):
+        self.channel = channel
+        self.window = window # Seconds to gather STATUS lines and deletions before sending them as one
+        self.reserve = reserve # Calls of each bucket the slow lane leaves for the fast lane
+        self.color = color # Of merged STATUS embeds
+        self.retries = retries # Times the slow lane retries a call discord answered 429
+        # Per channel limits as discord documents them at the time of writing
+        self.buckets = {
+            "send": Bucket(5, 5),
+            "delete": Bucket(5, 5),
+            "bulk": Bucket(1, 1),
+        }
+
+        self.queue = asyncio.Queue() # Slow lane: (bucket, coroutine function)
+        self.statuses = [] # STATUS lines waiting to be merged
+        self.deletions = [] # Message IDs waiting to be deleted
+        self.flush = None # Pending call_later for the above
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.flush:
+            self.flush.cancel()
+        self._flush()
+        if self.task and not self.task.done():
+            try:
+                await asyncio.wait_for(self.queue.join(), 5) # Let what's queued go out first
+            except asyncio.TimeoutError:
+                pass
+            self.task.cancel()
+
+    # Fast lane
+
+    async def urgent(self, *args, trace=None, kind=None, **kwargs):
+        # Send right now, ahead of anything queued. Never waits on our side - if the bucket really is spent,
+        # discord.py holds the call until discord lets it through. A trace, if given, is stamped around the send.
+        self.buckets["send"].spend()
+        try:
+            return await self._sent(self.channel.send(*args, **kwargs), trace, kind)
+        except (discord.RateLimited, discord.HTTPException) as e:
+            if (retry_after := self._retry_after(e)) is not None:
+                self.buckets["send"].hold(retry_after) # So the slow lane stays out of the way meanwhile
+            raise
+
+    # Slow lane
+
+    def send(self, *args, trace=None, kind=None, **kwargs):
+        self.queue.put_nowait(("send", lambda: self._sent(self.channel.send(*args, **kwargs), trace, kind)))
+
+    @staticmethod
+    async def _sent(sending, trace, kind):
+        if trace is None:
+            return await sending
+        trace.stamp("send")
+        message = await sending
+        tracer.record(trace.stamp("ack"), kind)
+        return message
+
+    def status(self, text):
+        self.statuses.append(str(text))
+        self._schedule()
+
+    def delete(self, message_id):
+        self.deletions.append(message_id)
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush is None:
+            self.flush = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        self.flush = None
+        if self.statuses:
+            lines, self.statuses = self.statuses, []
+            for description in self._chunks(lines, 4096):
+                embed = discord.Embed(description=description, color=self.color)
+                self.queue.put_nowait(("send", lambda embed=embed: self.channel.send(embed=embed)))
+
+        if self.deletions:
+            ids, self.deletions = list(dict.fromkeys(self.deletions)), []
+            for i in range(0, len(ids), 100): # Bulk delete takes 2-100 messages
+                chunk = ids[i:i + 100]
+                if len(chunk) == 1:
+                    self.queue.put_nowait(("delete", lambda message_id=chunk[0]: self._delete(message_id)))
+                else:
+                    self.queue.put_nowait(("bulk", lambda chunk=chunk: self._bulk_delete(chunk)))
+
+    @staticmethod
+    def _chunks(lines, limit):
+        chunk = ""
+        for line in lines:
+            line = line[:limit]
+            if chunk and len(chunk) + 1 + len(line) > limit:
+                yield chunk
+                chunk = ""
+            chunk = f"{chunk}\n{line}" if chunk else line
+        if chunk:
+            yield chunk
+
+    async def _delete(self, message_id):
+        # No fetch first - a partial message is all delete needs
+        try:
+            await self.channel.get_partial_message(message_id).delete()
+        except discord.NotFound: # Somebody beat us to it
+            pass
+
+    async def _bulk_delete(self, message_ids):
+        try:
+            await self.channel.delete_messages([discord.Object(id=message_id) for message_id in message_ids])
+        except discord.HTTPException as e: # e.g. something older than two weeks - one at a time instead
+            if e.status == 429: # Only rate limited - _run retries the bulk delete
+                raise
+            print(f"Bulk delete failed ({e}), deleting one by one")
+            for message_id in message_ids:
+                self.queue.put_nowait(("delete", lambda message_id=message_id: self._delete(message_id)))
+
+    @staticmethod
+    def _retry_after(error):
+        # Seconds a 429 asked us to wait, or None if error isn't one
+        if isinstance(error, discord.RateLimited):
+            return error.retry_after
+        if isinstance(error, discord.HTTPException) and error.status == 429:
+            try:
+                return float(error.response.headers.get("Retry-After", 1))
+            except (AttributeError, TypeError, ValueError):
+                return 1.0
+        return None
+
+    async def _run(self):
+        while True:
+            bucket, call = await self.queue.get()
+            try:
+                for attempt in range(self.retries + 1): # Retried in place, so nothing queued behind it overtakes it
+                    await self.buckets[bucket].acquire(self.reserve)
+                    try:
+                        await call()
+                        break
+                    except (discord.RateLimited, discord.HTTPException) as e:
+                        retry_after = self._retry_after(e)
+                        if retry_after is None or attempt == self.retries:
+                            raise
+                        self.buckets[bucket].hold(retry_after)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Motor failed to {bucket}")
+                print(e)
+            finally:
+                self.queue.task_done()
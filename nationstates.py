@@ -1,5 +1,11 @@
-import requests
+import asyncio
+import os
+import threading
 import time
+from typing import NamedTuple
+
+import aiohttp
+import requests
 from defusedxml import ElementTree as ET
 from RegionClass import Region
 from RegionBlock import RegionBlock
@@ -9,16 +15,28 @@ from RegionBlock import RegionBlock
 # E.g. - fetch the update time of a given region, or the number of endos on a given nation
 
 def makeHeaders(mainNation): # Allow overriding headers easily
-    headers = { 
+    headers = {
         "User-Agent":f"Scarab/0.1, Developed by Hesskin Empire and Volstrostia, in use by {mainNation}",
     }
     return headers
 
-headers = { 
+headers = {
     "User-Agent":f"Scarab/0.1, Developed by Hesskin Empire and Volstrostia",
 }
 
-def perform_request(url,headers=headers,data=None, override_ratelimit=False):
+# Where we send everything. Point SCARAB_NS_BASE at a mockns server (e.g. http://127.0.0.1:8081) to develop
+# or load-test without touching the real site. Read at call time, so it can also be reassigned at runtime.
+BASE = os.environ.get("SCARAB_NS_BASE", "https://www.nationstates.net").rstrip("/")
+
+def api(query):
+    return f"{BASE}/cgi-bin/api.cgi?{query}"
+
+class Response(NamedTuple):
+    status_code: int
+    headers: dict
+    text: str
+
+class RateLimit:
     # From https://www.nationstates.net/pages/api.html#ratelimits, retrieved on 13 April 2023
     #    RateLimit-Limit: Set to "50"; which means that there are a total of 50 requests available in the current time window. Use instead of hardcoding.
     #    RateLimit-Remaining: How many more requests can be made within the current time window.
@@ -27,62 +45,220 @@ def perform_request(url,headers=headers,data=None, override_ratelimit=False):
     #
     # A "request" is an HTTP request to the site for any amount of information and any number of shards.
     # That is, an HTTP request like this is a single request, even though it gathers information on three shards.
+    #
+    # We keep a live token bucket off those headers: every request we send takes a token, every response we get
+    # back corrects the bucket to whatever the server says. All times are time.monotonic().
 
-    #r = requests.get("https://www.nationstates.net/cgi-bin/api.cgi?nation=testlandia&q=ping",headers={"User-Agent":"cURL", "X-Password":"lolnicetry")
+    def __init__(self, limit=50, window=30, pad=0.5):
+        self.limit = limit
+        self.window = window # Fallback window length if the server never tells us one
+        self.pad = pad # Seconds added to a lockout to ensure we don't hit against the wall
+        self.remaining = limit
+        self.reset = 0.0 # When the current window ends
+        self.blocked = 0.0 # When a Retry-After lockout ends
 
-    if not headers:
-        print("Headers missing from request")
-        return None
+    def update(self, headers, status=200):
+        now = time.monotonic()
+        if "RateLimit-Limit" in headers:
+            self.limit = int(headers["RateLimit-Limit"])
+        if "RateLimit-Remaining" in headers:
+            remaining = int(headers["RateLimit-Remaining"])
+            # Answers to older requests don't count the ones we sent since. Never hand back tokens already taken this window.
+            self.remaining = min(self.remaining, remaining) if now < self.reset else remaining
+        if "RateLimit-Reset" in headers:
+            self.reset = now + float(headers["RateLimit-Reset"]) # Whole seconds from NS, fractions from a sped-up mockns
 
-    if not data: #do we POST?
-        r = requests.get(url,headers=headers) #no :(
-    else:
-        r = requests.post(url,headers=headers,data=data) #yes :3
-
-    if r.status_code == 200: # We did it! All done!
-        return r # In case we need to extract other data
-
-    elif r.status_code == 429: #Too many requests!
-        print("Hit ratelimit")
-        if "Retry-After" in r.headers:
-            time.sleep(int(r.headers['Retry-After']) + 0.5) #Extra half a second to ensure we don't hit against the wall
-        else:
-            if "Ratelimit-Reset" in r.headers:
-                time.sleep(int(r.headers['Ratelimit-Reset']) + 0.5)
+        if status == 429:
+            self.remaining = 0
+            if "Retry-After" in headers:
+                self.blocked = now + float(headers["Retry-After"]) + self.pad
+            elif "RateLimit-Reset" in headers:
+                self.blocked = self.reset + self.pad
+            else:
+                self.blocked = now + 31 # Well, we tried. Sitting out a full 31 seconds as a last resort.
+            self.reset = self.blocked # Budget comes back once the lockout is over
+
+    def delay(self):
+        # Seconds until we may send another request, 0 if we may send one right now
+        now = time.monotonic()
+        if now < self.blocked:
+            return self.blocked - now
+        if now >= self.reset: # Window rolled over, we have a fresh budget
+            self.remaining = max(self.remaining, self.limit)
+            self.reset = now + self.window
+        if self.remaining > 0:
+            return 0
+        return self.reset - now
+
+    def take(self):
+        self.remaining -= 1
+
+    def budget(self):
+        # (requests left, seconds until they are refilled) - used to pace pollers
+        self.delay()
+        return max(self.remaining, 0), max(self.reset - time.monotonic(), 0)
+
+class Client:
+    # One pooled keep-alive session for everything we ask of NS, running on its own event loop thread.
+    # Discord's loop awaits request(), plain threads (the backbrain) call request_sync(). Either way a
+    # spent budget only ever parks a coroutine on our loop, it never sleeps the caller's thread for us.
+
+    def __init__(self, headers=headers, connections=8):
+        self.headers = headers
+        self.connections = connections
+        self.ratelimit = RateLimit()
+        self.session = None # Created on our own loop, on first use
+        self.lock = asyncio.Lock() # Serializes token taking so bursts queue up in order
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="nsapi", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        # Schedule a coroutine on the client loop, returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def request(self, url, headers=None, data=None):
+        return await asyncio.wrap_future(self.submit(self._request(url, headers, data)))
+
+    def request_sync(self, url, headers=None, data=None):
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("request_sync called from the client loop - await request() instead")
+        return self.submit(self._request(url, headers, data)).result()
+
+    async def download(self, url, path, headers=None):
+        return await asyncio.wrap_future(self.submit(self._download(url, path, headers)))
+
+    def download_sync(self, url, path, headers=None):
+        return self.submit(self._download(url, path, headers)).result()
+
+    async def stream(self, url, headers=None):
+        # Open a long-lived response, e.g. server-sent events. Client loop only; the caller reads r.content and closes r.
+        session = await self._session()
+        await self._acquire()
+        r = await session.get(url, headers=headers or self.headers, timeout=aiohttp.ClientTimeout(total=None))
+        if r.status != 200:
+            self.ratelimit.update(r.headers, r.status)
+            r.release()
+            raise requests.exceptions.RequestException("ERROR: Response code {}".format(r.status))
+        return r
+
+    def close(self):
+        # Stops whatever still runs on our loop (pollers, streams), closes the session, then the loop thread
+        self.submit(self._shutdown()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    async def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self.session
+
+    async def _acquire(self):
+        async with self.lock:
+            while True:
+                wait = self.ratelimit.delay()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.ratelimit.take()
+
+    async def _request(self, url, headers=None, data=None):
+        session = await self._session()
+
+        for attempt in range(2): # Second go only ever happens after a 429
+            await self._acquire()
+            if not data: #do we POST?
+                pending = session.get(url, headers=headers or self.headers) #no :(
             else:
-                time.sleep(31) #Well, we tried. Sleeping a full 31 seconds as a last resort.
+                pending = session.post(url, headers=headers or self.headers, data=data) #yes :3
+
+            async with pending as r:
+                text = await r.text()
+                self.ratelimit.update(r.headers, r.status)
+
+                if r.status == 200: # We did it! All done!
+                    return Response(r.status, r.headers, text) # In case we need to extract other data
+
+                elif r.status == 429: #Too many requests! _acquire waits out the lockout before the retry
+                    print("Hit ratelimit")
+
+                else: #Some other bad evil status code we should never see
+                    raise requests.exceptions.RequestException("ERROR: Response code {}".format(r.status))
+
+        raise requests.exceptions.RetryError("Request failed twice in a row! Please file a bug report.")
+
+    async def _download(self, url, path, headers=None):
+        # Dumps are served from /pages/, outside the API ratelimit
+        session = await self._session()
+        async with session.get(url, headers=headers or self.headers, timeout=aiohttp.ClientTimeout(total=None)) as r:
+            if r.status != 200:
+                raise requests.exceptions.RequestException("ERROR: Response code {}".format(r.status))
+            with open(path, 'wb') as f:
+                async for chunk in r.content.iter_chunked(1 << 16):
+                    f.write(chunk)
+        return path
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    # Shared, lazily started client. Everything in the process goes through this one session.
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+    return _client
 
-        # We have now slept - give it a second go.
+def close():
+    # Shut the shared client down, e.g. at the end of a script. The next client() starts a fresh one
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
 
-        if not data:
-            r = requests.get(url,headers=headers)
-        else:
-            r = requests.post(url,headers=headers,data=data)
+def perform_request(url,headers=headers,data=None):
+    #r = requests.get("https://www.nationstates.net/cgi-bin/api.cgi?nation=testlandia&q=ping",headers={"User-Agent":"cURL", "X-Password":"lolnicetry")
 
-        if r.status_code == 200:
-            return r
+    if not headers:
+        print("Headers missing from request")
+        return None
 
-        else:
-            raise requests.exceptions.RetryError("Request failed twice in a row! Please file a bug report.")
+    return client().request_sync(url, headers=headers, data=data)
 
-    else: #Some other bad evil status code we should never see
-        raise requests.exceptions.RequestException("ERROR: Response code {}".format(r.status_code))
+async def fetch(url,headers=headers,data=None):
+    # perform_request for coroutines, e.g. cogs on the discord loop
+    if not headers:
+        print("Headers missing from request")
+        return None
 
-def download_file(url,headers=headers):
+    return await client().request(url, headers=headers, data=data)
+
+def download_file(url,headers=headers,local_filename=None):
 #    print(f"Downloading {url}")
-    local_filename = url.split('/')[-1]
-    with requests.get(url, stream=True, headers=headers) as r: # TODO: Ensure rate-limiting compliance? Should be fine though
-        with open(local_filename, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-    
-    return local_filename
+    if not local_filename:
+        local_filename = url.split('/')[-1]
+    return client().download_sync(url, local_filename, headers=headers)
 
 def nsify(string):
     return string.lower().replace(" ","_")
 
 def verify_nation(nation,code,headers=headers):
 #    https://www.nationstates.net/cgi-bin/api.cgi?a=verify&nation=(Nation Name)&checksum=(code)
-    r = perform_request(f"https://www.nationstates.net/cgi-bin/api.cgi?a=verify&nation={nation}&checksum={code}",headers=headers)
+    r = perform_request(api(f"a=verify&nation={nation}&checksum={code}"),headers=headers)
 #    print(r.text)
     if "1" in str(r.text):
         return True
@@ -91,17 +267,42 @@ def verify_nation(nation,code,headers=headers):
 
 def ping_point(point, jp="suspicious"):
     # view-source:https://www.nationstates.net/cgi-bin/api.cgi?nation=Volstrostia&q=region+wa
-    r = perform_request(f"https://www.nationstates.net/cgi-bin/api.cgi?nation={nsify(point)}&q=region+wa")
+    r = perform_request(api(f"nation={nsify(point)}&q=region+wa"))
     content = ET.fromstring(r.text)
     region = content.findtext("REGION")
     membership = content.findtext("UNSTATUS")
     if membership == "Non-member":
         return -1
-    
+
     if nsify(region) != nsify(jp):
         return -2
 
     return 1
 
+def regions_by_tag(*tags, headers=headers):
+    # https://www.nationstates.net/cgi-bin/api.cgi?q=regionsbytag;tags=password
+    r = perform_request(api(f"q=regionsbytag;tags={','.join(tags)}"),headers=headers)
+    regions = ET.fromstring(r.text).findtext("REGIONS") or ""
+    return {nsify(region) for region in regions.split(",") if region}
+
+def wa_members(headers=headers):
+    # Every WA member, nsified - one request for the lot
+    r = perform_request(api("wa=1&q=members"),headers=headers)
+    members = ET.fromstring(r.text).findtext("MEMBERS") or ""
+    return {nsify(nation) for nation in members.split(",") if nation}
+
+def region_nations(region, headers=headers):
+    # Every nation residing in a region, nsified
+    r = perform_request(api(f"region={nsify(region)}&q=nations"),headers=headers)
+    nations = ET.fromstring(r.text).findtext("NATIONS") or ""
+    return {nsify(nation) for nation in nations.split(":") if nation}
+
 def track_region(region):
-    pass
+    # Last update of a region as a unix timestamp. Anything newer than the dump's LastUpdate means it has updated.
+    r = perform_request(api(f"region={nsify(region)}&q=lastupdate"))
+    return int(ET.fromstring(r.text).findtext("LASTUPDATE"))
+
+async def lastupdate(region):
+    # track_region for coroutines
+    r = await fetch(api(f"region={nsify(region)}&q=lastupdate"))
+    return int(ET.fromstring(r.text).findtext("LASTUPDATE"))
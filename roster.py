@@ -0,0 +1,73 @@
+import threading
+import time
+
+import nationstates
+
+# Who is in the WA and who is sitting in the jump point, fetched before update so a point can be checked from memory.
+# Answers use ping_point's codes: 1 good to go, -1 not in the WA, -2 not in the jump point.
+
+
+class Entry:
+    def __init__(self, wa, region, fetched):
+        self.wa = wa # WA member?
+        self.region = region # Region it resides in (nsified), or None if we only know it isn't the jump point
+        self.fetched = fetched # time.monotonic() we learned this
+
+
+class Roster:
+    def __init__(self, ttl=900):
+        self.ttl = ttl # Seconds an entry is trusted for
+        self.entries = {} # Nsified nation -> Entry
+        self.lock = threading.Lock() # Filled from pool threads, read from the backbrain
+
+    def put(self, nation, wa, region=None):
+        with self.lock:
+            self.entries[nationstates.nsify(nation)] = Entry(wa, region and nationstates.nsify(region), time.monotonic())
+
+    def get(self, nation):
+        # Fresh entry for the nation, or None
+        with self.lock:
+            entry = self.entries.get(nationstates.nsify(nation))
+        if entry and time.monotonic() - entry.fetched <= self.ttl:
+            return entry
+        return None
+
+    def status(self, nation, jp):
+        # ping_point's answer for the nation from memory, or None if we don't know
+        entry = self.get(nation)
+        if not entry:
+            return None
+        if not entry.wa:
+            return -1
+        if entry.region != nationstates.nsify(jp):
+            return -2
+        return 1
+
+    def learn(self, nation, jp, status):
+        # Remember the answer to a live ping_point
+        if status == 1:
+            self.put(nation, True, jp)
+        elif status == -1:
+            self.put(nation, False)
+        elif status == -2:
+            self.put(nation, True)
+
+    def refresh(self, jp, nations=(), headers=nationstates.headers):
+        """
+        Fill the roster for everyone in the jump point plus the given nations, in two requests however many there are.
+        Blocking - run it off the backbrain thread.
+        :param jp: Jump point
+        :param nations: Further nations we want answers for, e.g. every verified updater
+        :return: Number of nations filled in
+        """
+        members = nationstates.wa_members(headers=headers)
+        residents = nationstates.region_nations(jp, headers=headers)
+        now = time.monotonic()
+        jp = nationstates.nsify(jp)
+
+        fresh = {}
+        for nation in {nationstates.nsify(nation) for nation in nations} | residents:
+            fresh[nation] = Entry(nation in members, jp if nation in residents else None, now)
+        with self.lock:
+            self.entries.update(fresh)
+        return len(fresh)
@@ -14,13 +14,15 @@ CREATE TABLE IF NOT EXISTS "Region"
 "LastMajorUpdate" float ,
 "LastMinorUpdate" float ,
 "hasPassword" integer ,
-"hasGovernor" integer
+"hasGovernor" integer ,
+"NormName" varchar
 );
 CREATE TABLE IF NOT EXISTS "Nation"
 (
 "ID" integer ,
 "Name" varchar ,
-"Region" integer
+"Region" integer ,
+"NormName" varchar
 );
 CREATE VIEW IF NOT EXISTS UpdateData AS
 SELECT
@@ -33,7 +35,7 @@ FROM ud_1;
 
 CREATE TABLE IF NOT EXISTS "Updaters"
 (
-"updaterID" integer,
+"updaterID" integer primary key,
 "org" varchar,
 "rank" varchar,
 "nation" varchar,
@@ -54,7 +56,7 @@ CREATE TABLE IF NOT EXISTS "Hits"
 (
 "tagID" integer,
 "point" integer,
-"region" integer,
+"region" integer
 );
 CREATE VIEW IF NOT EXISTS tagRecords AS
 SELECT
@@ -62,4 +64,10 @@ SELECT
     (SELECT Name FROM Region WHERE ID = Hits.region) AS Target,
     (SELECT date FROM Tag WHERE tagID = Hits.tagID) AS date
 FROM Hits
-INNER JOIN Updaters ON Hits.point = Updaters.updaterID;
\ No newline at end of file
+INNER JOIN Updaters ON Hits.point = Updaters.updaterID;
+-- Updaters tables from before updaterID was the primary key: number the rows, and every row added from now on
+UPDATE Updaters SET updaterID = rowid + (SELECT coalesce(max(updaterID), 0) FROM Updaters) WHERE updaterID IS NULL;
+CREATE TRIGGER IF NOT EXISTS "UpdaterID" AFTER INSERT ON "Updaters" WHEN NEW.updaterID IS NULL
+BEGIN
+UPDATE Updaters SET updaterID = (SELECT coalesce(max(updaterID), 0) + 1 FROM Updaters) WHERE rowid = NEW.rowid;
+END;
\ No newline at end of file
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import numpy as np
+
+import nationstates
+from mockns import MockNS
+from updateorder import UpdateOrder
+
+# Back-testing for targeting. Replays a dump's update times through mockns, sped up, and runs the real backbrain
+# against it: it plans, watches triggers and sends GOs exactly as on a live night, and we score every GO against when
+# the target actually updated in the replay. Parameter sweeps run one trial per process.
+#   python simulator.py data.10.18.2026.db --speed 20 --triggerlen 2 3 4 5 --switch 20 30 45 --workers 4
+#   python simulator.py --synthetic 30000 --speed 100 --drift 0.1 --pace 1.1
+#
+# Every trial runs in a process of its own, which lets it wind the clock: time.time() reads replay time, so the
+# estimator and watcher see the update at the pace NS would run it. The ratelimit window shrinks by the same factor,
+# so the poll budget per replayed second is the real one. Round trips on this machine are real seconds though, which
+# count speed times over - at 100x, a 2ms hop is 0.2s of replay. Compare settings at the same speed, and don't run
+# more workers than there are cores: trials starved of CPU react late.
+
+
+class Clock:
+    # Replay time, running speed times faster than real time from origin (a unix time)
+
+    def __init__(self, origin, speed):
+        self.origin = origin
+        self.speed = speed
+        self.start = time.monotonic()
+
+    def now(self):
+        return self.origin + (time.monotonic() - self.start) * self.speed
+
+    def real(self, when):
+        # time.monotonic() at which replay time reaches when
+        return self.start + (when - self.origin) / self.speed
+
+
+def tonight(index, is_minor=False, jitter=0.5, drift=0.0, pace=1.0, shift=0.0, seed=0, now=None):
+    """
+    Works out when each region updates in the replay, from the dump's update times.
+    :param index: UpdateOrder of the dump
+    :param is_minor: Replay minor rather than major update
+    :param jitter: Standard deviation of the noise on each region's update time, seconds
+    :param drift: How much slower (positive) or faster the server is running by the end of update than at the start, e.g. 0.1
+    :param pace: Length of tonight's update against the dump's, e.g. 1.1 for a night 10% slower throughout
+    :param shift: Seconds tonight's update starts after the dump's, once moved to today
+    :param seed: Random seed for the jitter
+    :param now: Unix time to move the dump's update to, in whole days, at least one. Defaults to the current time
+    :return: {nsified region name: update time}
+    """
+    times = index.times(is_minor)
+    valid = ~np.isnan(times)
+    if not valid.any():
+        return {}
+    first = float(np.nanmin(times))
+    total = max(float(np.nanmax(times)) - first, 1.0)
+    offset = times - first
+    stretched = pace * (offset + drift * offset ** 2 / (2 * total))  # Speed changing linearly across the update
+    days = max(round(((now or time.time()) - first) / 86400), 1)  # Never the dump's own update, that's the baseline
+    noise = np.random.default_rng(seed).normal(0, jitter, len(times)) if jitter else 0
+    when = first + days * 86400 + shift + stretched + noise
+    return {nationstates.nsify(index.names[row]): float(when[row]) for row in np.flatnonzero(valid)}
+
+
+class Replay(MockNS):
+    # mockns with regions updating on a schedule, on its own loop thread
+
+    def __init__(self, dump, schedule, clock, window=30, latency=0.0, **kwargs):
+        super().__init__(dump, window=window / clock.speed, latency=latency / clock.speed, **kwargs)
+        self.schedule = schedule
+        self.clock = clock
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="replay", daemon=True)
+        self.task = None
+
+    def serve(self):
+        # Starts serving and replaying. Returns the base URL.
+        self.thread.start()
+        base = asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        self.task = asyncio.run_coroutine_threadsafe(self.play(), self.loop) # Held, or the loop may drop it half way
+        return base
+
+    def close(self):
+        self.task.cancel()
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def play(self):
+        for when, region in sorted((when, region) for region, when in self.schedule.items()):
+            wait = self.clock.real(when) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.updated(region, when)
+
+
+class Simulation:
+    def __init__(self, schedule, clock, triggerlen=3, switchlen=30, is_minor=False, updaters=6, reaction=1.5,
+                 spread=0.5, early_by=5.0, mode="raw", delay=0.0, stream=True, seed=0):
+        """
+        :param schedule: {region: update time}, from tonight()
+        :param clock: Replay Clock
+        :param triggerlen: Backbrain trigger length, seconds
+        :param switchlen: Backbrain switch time between targets, seconds
+        :param is_minor: Tag minor rather than major update
+        :param updaters: Updaters present, as the cog would tell the backbrain with INITUPDATERS
+        :param reaction: Mean seconds from the GO to the updaters' moves landing
+        :param spread: Standard deviation of the reaction time
+        :param early_by: A move landing more than this many seconds before the target updates is early - there is time to see it
+        :param mode: "raw" (GO on the trigger) or "timed" (GO delay seconds after it)
+        :param delay: Seconds to hold GO after the trigger in timed mode
+        :param stream: Let the backbrain use the happenings stream, as it does live. False polls only
+        :param seed: Random seed for the reaction times
+        """
+        self.schedule = schedule
+        self.clock = clock
+        self.triggerlen = triggerlen
+        self.switchlen = switchlen
+        self.is_minor = is_minor
+        self.updaters = updaters
+        self.reaction = reaction
+        self.spread = spread
+        self.early_by = early_by
+        self.mode = mode
+        self.delay = delay
+        self.stream = stream
+        self.random = random.Random(seed)
+        self.end = max(schedule.values()) + 10
+
+    async def run(self):
+        # Imported here, once nationstates.BASE points at the replay
+        import synapse
+        from backbrain import BackBrain, codes
+
+        commands, responses = synapse.bridge(priorities=codes.priorities)
+        brain = BackBrain({"User-Agent": "SCARAB simulator"}, commands, responses)
+        brain.triggerlen, brain.switchlen = self.triggerlen, self.switchlen
+        brain.watcher.fastest /= self.clock.speed
+        brain.watcher.client.ratelimit.window /= self.clock.speed  # Assumed between responses, keep it in step with the mock
+        brain.watcher.client.ratelimit.pad /= self.clock.speed
+        if not self.stream:
+            brain.watcher.stream.stop()
+            brain.watcher.stream = None
+
+        score = {"targets": 0, "hits": 0, "early": 0, "misses": 0, "skipped": 0, "exhausted": False}
+        leads = []
+        target = None
+        commands.put((codes.commands.BEGINTAG, self.is_minor))
+        commands.put((codes.commands.INITUPDATERS, self.updaters))
+        commands.put((codes.commands.GETTARG,))
+        while self.clock.now() < self.end:
+            try:
+                response = await asyncio.wait_for(responses.get(), max(self.clock.real(self.end) - time.monotonic(), 0.1))
+            except asyncio.TimeoutError:
+                break
+            code = response[0]
+
+            if code == codes.responses.TARGET:
+                target = nationstates.nsify(response[1])
+                score["targets"] += 1
+                if self.mode == "timed":
+                    commands.put((codes.commands.TIMEDTRIGGER, self.delay / self.clock.speed))
+                else:
+                    commands.put((codes.commands.RAWWATCHTRIGGER,))
+
+            elif code == codes.responses.GO and target:
+                landed = self.clock.now() + max(self.random.gauss(self.reaction, self.spread), 0)
+                updates = self.schedule.get(target)
+                if updates is not None: # Every target comes from the replayed dump, but don't hang if one doesn't
+                    lead = updates - landed
+                    leads.append(lead)
+                    score["misses" if lead <= 0 else "early" if lead > self.early_by else "hits"] += 1
+                    # Next target once this one has updated, as updaters would
+                    await asyncio.sleep(max(self.clock.real(updates) - time.monotonic(), 0) + 0.05)
+                target = None
+                commands.put((codes.commands.GETTARG,))
+
+            elif code == codes.responses.SKIPTARG:
+                score["skipped"] += 1
+                commands.put((codes.commands.SKIPTARG,))
+
+            elif code == codes.responses.EXHAUSTED:
+                score["exhausted"] = True
+                break
+
+        commands.put((codes.commands.ENDTAG,))
+        commands.put((codes.commands.EXIT,))
+        await asyncio.to_thread(brain.join, 5)
+
+        leads.sort()
+        score["lead_p50"] = leads[len(leads) // 2] if leads else None
+        score["lead_min"] = leads[0] if leads else None
+        return score
+
+
+def trial(dump, triggerlen=3, switchlen=30, speed=20.0, jitter=0.5, drift=0.0, pace=1.0, shift=0.0, is_minor=False,
+          latency=0.0, failure=0.0, seed=0, **settings):
+    """
+    One replayed update, scored. Winds time.time() to replay time, so run it in a process of its own (see sweep()).
+    :param dump: Dump database to replay
+    :param triggerlen: Backbrain trigger length, seconds
+    :param switchlen: Backbrain switch time, seconds
+    :param speed: Replay speed, 1 for real time
+    :param jitter: See tonight()
+    :param drift: See tonight()
+    :param pace: See tonight()
+    :param shift: See tonight()
+    :param is_minor: Replay and tag minor rather than major update
+    :param latency: Seconds (replay time) the mock API takes to answer
+    :param failure: Chance of a spurious 429 per request
+    :param seed: Random seed for the replay and the updaters
+    :param settings: Further Simulation settings
+    :return: Settings and score of the trial
+    """
+    dump = os.path.abspath(dump)
+    index = UpdateOrder.load(dump)
+    schedule = tonight(index, is_minor, jitter, drift, pace, shift, seed)
+    if not schedule:
+        raise ValueError(f"{dump} has no {'minor' if is_minor else 'major'} update times to replay")
+    clock = Clock(min(schedule.values()) - 30, speed)  # Half a minute before update, to get planned and watching
+
+    scratch = tempfile.mkdtemp(prefix="scarab-sim-")
+    os.symlink(dump, os.path.join(scratch, f"data.{date.today().strftime('%m.%d.%Y')}.db"))  # Where dump_file() looks
+    cwd, wall = os.getcwd(), time.time
+    os.chdir(scratch)
+    replay = Replay(dump, schedule, clock, latency=latency, failure=failure, seed=seed)
+    time.time = clock.now
+    try:
+        nationstates.BASE = replay.serve()
+        score = asyncio.run(Simulation(schedule, clock, triggerlen, switchlen, is_minor, seed=seed, **settings).run())
+        score["requests"] = replay.stats["requests"]
+        score["429"] = replay.stats["429"]
+    finally:
+        nationstates.close()  # The watcher's and everyone else's session, and the pollers still on its loop
+        replay.close()
+        time.time = wall
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return dict(triggerlen=triggerlen, switchlen=switchlen, speed=speed, jitter=jitter, drift=drift, pace=pace,
+                shift=shift, is_minor=is_minor, seed=seed, **settings, **score)
+
+
+def _trial(kwargs):
+    with contextlib.redirect_stdout(sys.stderr):  # Backbrain chatter
+        return trial(**kwargs)
+
+
+def sweep(dump, triggerlens=(3,), switchlens=(30,), repeats=1, workers=None, progress=print, **settings):
+    """
+    Runs a trial for every combination of trigger length and switch time, repeats times each with different seeds,
+    in parallel. Every trial gets a fresh process.
+    :return: One summary per combination, best first: hits, then fewest misses, then fewest early
+    """
+    seed = settings.pop("seed", 0)
+    jobs = [dict(dump=dump, triggerlen=triggerlen, switchlen=switchlen, seed=seed + repeat, **settings)
+            for triggerlen, switchlen, repeat in itertools.product(triggerlens, switchlens, range(repeats))]
+
+    results = {}
+    context = multiprocessing.get_context("spawn")  # Trials wind the clock and hold process-wide clients
+    with ProcessPoolExecutor(workers, mp_context=context, max_tasks_per_child=1) as pool:
+        for future in as_completed([pool.submit(_trial, job) for job in jobs]):
+            result = future.result()
+            progress(f"triggerlen {result['triggerlen']} switch {result['switchlen']} seed {result['seed']}: "
+                     f"{result['hits']} hits, {result['early']} early, {result['misses']} misses, {result['skipped']} skipped")
+            key = (result["triggerlen"], result["switchlen"])
+            summary = results.setdefault(key, {"triggerlen": key[0], "switchlen": key[1], "trials": 0, "targets": 0,
+                                               "hits": 0, "early": 0, "misses": 0, "skipped": 0, "requests": 0, "429": 0})
+            summary["trials"] += 1
+            for field in ("targets", "hits", "early", "misses", "skipped", "requests", "429"):
+                summary[field] += result[field]
+
+    return sorted(results.values(), key=lambda s: (-s["hits"], s["misses"], s["early"]))
+
+
+def synthesize(regions, nations, seed=0):
+    # Synthetic dump in a temporary directory, for when there is no real one to hand
+    import dumpdb
+
+    path = os.path.join(tempfile.mkdtemp(prefix="scarab-dump-"), "synthetic.db")
+    dumpdb.synthesize(path, regions, nations, seed)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a dump's update at speed and score the backbrain's targeting")
+    parser.add_argument("dump", nargs="?", help="Dump database to replay")
+    parser.add_argument("--synthetic", type=int, metavar="REGIONS", help="Replay a synthetic dump with this many regions instead")
+    parser.add_argument("--speed", type=float, default=20, help="Replay speed, 1 to 100")
+    parser.add_argument("--triggerlen", type=int, nargs="+", default=[3])
+    parser.add_argument("--switch", type=int, nargs="+", default=[30])
+    parser.add_argument("--repeats", type=int, default=1, help="Trials per combination, each with its own seed")
+    parser.add_argument("--workers", type=int, help="Trials run at once. Defaults to the CPU count")
+    parser.add_argument("--minor", action="store_true")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Noise on each region's update time, seconds")
+    parser.add_argument("--drift", type=float, default=0.0, help="Slowdown of the server by the end of update, e.g. 0.1")
+    parser.add_argument("--pace", type=float, default=1.0, help="Length of the replayed update against the dump's")
+    parser.add_argument("--shift", type=float, default=0.0, help="Seconds the replayed update starts late")
+    parser.add_argument("--updaters", type=int, default=6)
+    parser.add_argument("--reaction", type=float, default=1.5, help="Mean seconds from GO to moves landing")
+    parser.add_argument("--spread", type=float, default=0.5, help="Standard deviation of the reaction time")
+    parser.add_argument("--early-by", type=float, default=5.0, help="Landing more than this long before the target updates is early")
+    parser.add_argument("--mode", choices=["raw", "timed"], default="raw")
+    parser.add_argument("--delay", type=float, default=0.0, help="GO delay after the trigger in timed mode, seconds")
+    parser.add_argument("--poll-only", action="store_true", help="Don't use the happenings stream")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock API response time, seconds")
+    parser.add_argument("--failure", type=float, default=0.0, help="Chance of a spurious 429 per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the summaries here as JSON")
+    args = parser.parse_args()
+
+    if not args.dump and not args.synthetic:
+        parser.error("give a dump to replay, or --synthetic")
+    if not 1 <= args.speed <= 100:
+        print(f"Replaying at {args.speed}x - outside 1-100x, local round trips and timers will skew results", file=sys.stderr)
+    dump = args.dump or synthesize(args.synthetic, args.synthetic * 8, args.seed)
+
+    summaries = sweep(
+        dump, args.triggerlen, args.switch, args.repeats, args.workers, progress=lambda line: print(line, file=sys.stderr),
+        speed=args.speed, jitter=args.jitter, drift=args.drift, pace=args.pace, shift=args.shift, is_minor=args.minor,
+        latency=args.latency, failure=args.failure, seed=args.seed, updaters=args.updaters, reaction=args.reaction,
+        spread=args.spread, early_by=args.early_by, mode=args.mode, delay=args.delay, stream=not args.poll_only,
+    )
+
+    print(f"{'triggerlen':>10} {'switch':>6} {'targets':>7} {'hits':>5} {'early':>5} {'misses':>6} {'skipped':>7}")
+    for s in summaries:
+        print(f"{s['triggerlen']:>10} {s['switchlen']:>6} {s['targets']:>7} {s['hits']:>5} {s['early']:>5} {s['misses']:>6} {s['skipped']:>7}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summaries, f, indent=2)
+    if not args.dump:
+        shutil.rmtree(os.path.dirname(dump), ignore_errors=True)
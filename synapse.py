@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import itertools
+import time
+from queue import Queue
+
+from latency import trace
+
+# The bridge between the backbrain thread and the discord event loop.
+# Both directions wake their reader directly - nobody polls:
+#   CommandQueue: discord loop -> backbrain. The backbrain blocks in get() until something arrives (or its timeout passes)
+#   ResponseQueue: backbrain -> discord loop. put() hands the item to the loop thread-safely, the brainstem awaits get()
+# Whatever goes through either comes out as a latency.Trace, stamped when it was queued and picked up on the way.
+
+# Command priority classes, most urgent first
+CRITICAL = 0 # Anything that decides or times a GO: points, triggers, targets
+TAG = 1 # Starting and stopping a tag
+ROUTINE = 2 # Everything else
+BULK = 3 # Slow, bursty traffic that can always wait - e.g. verification
+CLASSES = {CRITICAL: "critical", TAG: "tag", ROUTINE: "routine", BULK: "bulk"}
+
+
+class ClassStats:
+    def __init__(self):
+        self.depth = 0 # Commands of this class waiting right now
+        self.served = 0 # Commands of this class handed out so far
+        self.waited = 0.0 # Total seconds they spent queued
+        self.longest = 0.0 # Longest any of them spent queued
+        self.last = 0.0 # Seconds the last one spent queued
+
+    def report(self):
+        return {
+            "depth": self.depth,
+            "served": self.served,
+            "mean_wait": self.waited / self.served if self.served else 0.0,
+            "max_wait": self.longest,
+            "last_wait": self.last,
+        }
+
+
+class CommandQueue(Queue):
+    """
+    Commands headed for the backbrain.
+    Thread-safe: put() from the loop never blocks, and wakes a backbrain parked in get().
+    Commands come out by priority class (see CLASSES), first-in first-out within a class, so a burst of
+    verifications or pings never holds up a point or a trigger queued behind it.
+    """
+
+    def __init__(self, priorities=None, maxsize=0):
+        """
+        :param priorities: Command code -> priority class. Codes not in it are ROUTINE
+        :param maxsize: As for queue.Queue
+        """
+        self.priorities = priorities or {}
+        super().__init__(maxsize)
+
+    # queue.Queue calls these with its lock held
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.sequence = itertools.count() # Keeps each class first-in first-out
+        self.classes = {priority: ClassStats() for priority in CLASSES}
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item):
+        priority = self.priorities.get(item[0], ROUTINE)
+        item = trace(item, "cmd_queued")
+        heapq.heappush(self.queue, (priority, next(self.sequence), item.stamps[-1][1], item))
+        self.classes[priority].depth += 1
+
+    def _get(self):
+        priority, sequence, queued, item = heapq.heappop(self.queue)
+        waited = time.monotonic() - queued
+        stats = self.classes[priority]
+        stats.depth -= 1
+        stats.served += 1
+        stats.waited += waited
+        stats.longest = max(stats.longest, waited)
+        stats.last = waited
+        return item.stamp("cmd_picked")
+
+    def stats(self):
+        """
+        Queue depth and wait times of each priority class. Safe to call from any thread.
+        :return: {class name: {"depth", "served", "mean_wait", "max_wait", "last_wait"}}, waits in seconds
+        """
+        with self.mutex:
+            return {CLASSES[priority]: stats.report() for priority, stats in self.classes.items()}
+
+
+class ResponseQueue:
+    """
+    Responses headed for discord.
+    put() is safe to call from any thread; the item lands in an asyncio.Queue on the owning loop,
+    waking whoever is awaiting get() on the very next loop iteration.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, trace(item, "resp_queued"))
+
+    async def get(self):
+        return (await self.queue.get()).stamp("resp_picked")
+
+    def empty(self):
+        return self.queue.empty()
+
+    def task_done(self):
+        self.queue.task_done()
+
+
+def bridge(loop=None, priorities=None):
+    """
+    Build a matched pair of queues for a BackBrain.
+    :param loop: Loop the responses are delivered to. Defaults to the running loop.
+    :param priorities: Command code -> priority class, e.g. backbrain.codes.priorities
+    :return: (commands, responses)
+    """
+    return CommandQueue(priorities), ResponseQueue(loop)
@@ -0,0 +1,93 @@
+import math
+
+import pytest
+
+import dumpdb
+from chooser import TagPlan
+from updateorder import UpdateOrder
+
+# UpdateOrder.successors and TagPlan against a plain reading of their definitions, one region at a time,
+# on a small synthetic dump. Its update times carry a little jitter, so the out-of-order paths get exercised too.
+
+
+@pytest.fixture(scope="module")
+def dump(tmp_path_factory):
+    path = tmp_path_factory.mktemp("dump") / "synthetic.db"
+    dumpdb.synthesize(str(path), regions=400, nations=4000, seed=7)
+    return str(path)
+
+
+@pytest.fixture(scope="module", params=["table", "search"])
+def index(request, dump):
+    order = UpdateOrder.load(dump)
+    if request.param == "search":  # Same dump without its Trigger table: every trigger searched for
+        order = UpdateOrder(order_rows(order))
+    return order
+
+
+def order_rows(order):
+    return [(int(order.ids[row]), order.names[row],
+             None if math.isnan(order.major[row]) else float(order.major[row]),
+             None if math.isnan(order.minor[row]) else float(order.minor[row]),
+             int(order.nations[row]), int(order.flags[row])) for row in range(len(order))]
+
+
+def brute_trigger(index, row, trigger_time, is_minor):
+    # Last region updating at least trigger_time seconds before row
+    times = index.times(is_minor)
+    found = None
+    for other in range(len(index)):
+        if index.flags[other] & UpdateOrder.MINOR and times[other] <= times[row] - trigger_time:
+            found = other
+    return found
+
+
+def brute_successors(index, switch_time, trigger_time, is_minor):
+    times = index.times(is_minor)
+    rows, triggers = [], []
+    for row in range(len(index)):
+        if (index.flags[row] & UpdateOrder.TARGETABLE) != UpdateOrder.TARGETABLE or math.isnan(times[row]):
+            continue
+        trigger = brute_trigger(index, row, trigger_time, is_minor)
+        if trigger is not None:
+            rows.append(row)
+            triggers.append(trigger)
+
+    successor = []
+    for i, row in enumerate(rows):
+        successor.append(next((j for j in range(len(rows))
+                               if times[rows[j]] > times[row] + switch_time and triggers[j] > row), len(rows)))
+    return rows, triggers, successor
+
+
+@pytest.mark.parametrize("is_minor", [False, True])
+@pytest.mark.parametrize("trigger_time, switch_time", [(3, 30), (7, 10), (2.5, 0)])
+def test_successors(index, is_minor, trigger_time, switch_time):
+    rows, triggers, successor = index.successors(switch_time, trigger_time, is_minor)
+    expected = brute_successors(index, switch_time, trigger_time, is_minor)
+    assert (rows.tolist(), triggers.tolist(), successor.tolist()) == expected
+
+
+@pytest.mark.parametrize("is_minor", [False, True])
+def test_plan(index, is_minor):
+    trigger_time, switch_time = 3, 30
+    rows, triggers, successor = brute_successors(index, switch_time, trigger_time, is_minor)
+    times = index.times(is_minor)
+
+    for after_row in (0, len(index) // 3, len(index) // 2, len(index) - 1):
+        plan = TagPlan(index, is_minor, trigger_time, switch_time, after_row)
+        first = next((j for j in range(len(rows))
+                      if times[rows[j]] > times[after_row] + switch_time and triggers[j] > after_row), len(rows))
+
+        chain, position = [], first
+        while position < len(rows):
+            chain.append(position)
+            position = successor[position]
+        entries = plan.entries()
+        assert [index.names[rows[i]] for i in chain] == [entry.target.name for entry in entries]
+        assert [index.names[triggers[i]] for i in chain] == [entry.trigger.name for entry in entries]
+        assert [len(chain) - k for k in range(len(chain))] == [entry.hits for entry in entries]
+        assert len(plan) == len(chain)
+
+        for entry in entries:  # Trigger ahead of its target by at least trigger_time, reported as a positive gap
+            assert entry.trigger_time >= trigger_time
@@ -0,0 +1,197 @@
+import sqlite3
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from nationstates import nsify
+
+
+class UpdateOrder:
+    """The Region table of a dump, held as column arrays in update (ID) order.
+
+    Answers the same questions chooser used to send to SQLite, but from memory: trigger lookups are a
+    searchsorted, and the targetable filter is a precomputed mask. Results match the SQL row for row,
+    including for dumps whose timestamps are not perfectly monotonic.
+    """
+
+    # Packed per-region flags. Each bit is set when the matching SQL condition is TRUE (not NULL).
+    EXECUTIVE = 1  # DelegateAuth & 3 = 3
+    OPEN = 2  # NOT hasPassword
+    VACANT = 4  # NOT DelegateVotes
+    MINOR = 8  # LastMinorUpdate != 0
+    TARGETABLE = EXECUTIVE | OPEN | VACANT | MINOR
+
+    # Triggers precomputed at dump time for these lengths (seconds), see dumpdb.build_triggers
+    TRIGGER_LENGTHS = range(2, 11)
+    TRIGGER_QUERY = 'SELECT Region, Minor, Length, Trigger FROM "Trigger"'
+
+    QUERY = '''
+        SELECT
+            ID, Name, LastMajorUpdate, LastMinorUpdate, NumNations,
+            ((DelegateAuth & 3 = 3) IS 1)
+            | (((NOT hasPassword) IS 1) << 1)
+            | (((NOT DelegateVotes) IS 1) << 2)
+            | (((LastMinorUpdate != 0) IS 1) << 3) AS Flags
+        FROM Region
+        ORDER BY ID
+    '''
+
+    def __init__(self, rows, triggers=None):
+        """Builds the index.
+
+        Args:
+            rows: (ID, Name, LastMajorUpdate, LastMinorUpdate, NumNations, Flags) rows in ID order, as selected by QUERY.
+            triggers: (Region, Minor, Length, Trigger) rows of the dump's Trigger table, as selected by TRIGGER_QUERY.
+                None if the dump doesn't have one, in which case every trigger is searched for.
+        """
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.names: List[str] = [row[1] for row in rows]
+        self.major = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=np.float64)
+        self.minor = np.array([np.nan if row[3] is None else row[3] for row in rows], dtype=np.float64)
+        self.nations = np.array([row[4] or 0 for row in rows], dtype=np.int64)
+        self.cumulative = np.cumsum(self.nations)  # Nations updated once each region is done - where update is, in work
+        self.flags = np.array([row[5] for row in rows], dtype=np.uint8)
+        self.by_name = {nsify(name): int(region_id) for region_id, name in zip(self.ids, self.names) if name is not None}
+
+        self._triggers = {False: self._trigger_table(self.major), True: self._trigger_table(self.minor)}
+        self._targets = {False: self._target_table(self.major), True: self._target_table(self.minor)}
+        self.trigger_rows = self._load_triggers(triggers) if triggers is not None else None
+        self._trigger_lists = self.trigger_rows.tolist() if self.trigger_rows is not None else None  # Cheaper one at a time
+
+    @classmethod
+    def load(cls, path) -> 'UpdateOrder':
+        """Builds the index straight from a dump file, for callers without an event loop (e.g. the backbrain)."""
+        db = sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro&immutable=1', uri=True)
+        try:
+            try:
+                triggers = db.execute(cls.TRIGGER_QUERY).fetchall()
+            except sqlite3.OperationalError:  # Dump from before the Trigger table
+                triggers = None
+            return cls(db.execute(cls.QUERY).fetchall(), triggers)
+        finally:
+            db.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _load_triggers(self, triggers):
+        # [minor][length][row] -> trigger row. -1: nothing updates early enough, -2: not precomputed, search for it
+        table = np.full((2, len(self.TRIGGER_LENGTHS), len(self.ids)), -2, dtype=np.int32)
+        if triggers:
+            region, minor, length, trigger = (np.array(column, dtype=np.float64) for column in zip(*triggers))
+            rows = np.searchsorted(self.ids, region)
+            found = np.isin(region, self.ids) & np.isin(length, self.TRIGGER_LENGTHS)
+            trigger_rows = np.where(np.isnan(trigger), -1, np.searchsorted(self.ids, np.nan_to_num(trigger)))
+            table[minor[found].astype(int), (length[found] - self.TRIGGER_LENGTHS[0]).astype(int), rows[found]] = \
+                trigger_rows[found]
+        return table
+
+    def _trigger_table(self, times):
+        # Candidate triggers, plus the suffix minimum of their times. The last candidate updating at or before
+        # some time x is the last one whose suffix minimum is <= x, and the suffix minimum is sorted.
+        rows = np.flatnonzero((self.flags & self.MINOR).astype(bool) & ~np.isnan(times))
+        suffix_min = np.minimum.accumulate(times[rows][::-1])[::-1]
+        return rows, suffix_min
+
+    def _target_table(self, times):
+        # Targetable regions, plus the prefix maximum of their times. The first one updating after some time x
+        # is the first whose prefix maximum is > x. When times are sorted the rest follow it contiguously.
+        mask = (self.flags & self.TARGETABLE) == self.TARGETABLE
+        rows = np.flatnonzero(mask & ~np.isnan(times))
+        target_times = times[rows]
+        prefix_max = np.maximum.accumulate(target_times) if len(rows) else target_times
+        monotonic = bool(np.all(np.diff(target_times) >= 0))
+        return rows, target_times, prefix_max, monotonic
+
+    def times(self, is_minor: bool = False) -> np.ndarray:
+        return self.minor if is_minor else self.major
+
+    def region_id(self, name: str) -> Optional[int]:
+        """Gets the ID of a region by name, in any capitalisation and with spaces or underscores. None if there is no such region."""
+        return self.by_name.get(nsify(name))
+
+    def row(self, region_id: int) -> Optional[int]:
+        """Gets the array row of a region ID, or None if there is no such region."""
+        i = int(np.searchsorted(self.ids, region_id))
+        if i < len(self.ids) and self.ids[i] == region_id:
+            return i
+        return None
+
+    def trigger(self, row: int, trigger_time: float, is_minor: bool = False) -> Optional[int]:
+        """Gets the row of the last region updating at least trigger_time seconds before the given row.
+
+        Returns:
+            The trigger's row, or None if nothing updates early enough.
+        """
+        if self._trigger_lists is not None and trigger_time in self.TRIGGER_LENGTHS:
+            trigger = self._trigger_lists[is_minor][int(trigger_time) - self.TRIGGER_LENGTHS[0]][row]
+            if trigger != -2:
+                return None if trigger < 0 else trigger
+        x = self.times(is_minor)[row] - trigger_time
+        if np.isnan(x):
+            return None
+        rows, suffix_min = self._triggers[is_minor]
+        k = int(np.searchsorted(suffix_min, x, side='right')) - 1
+        if k < 0:
+            return None
+        return int(rows[k])
+
+    def triggers(self, rows: np.ndarray, trigger_time: float, is_minor: bool = False) -> np.ndarray:
+        """Vectorised trigger(): the trigger row for each of the given rows, or -1 where nothing updates early enough."""
+        if self.trigger_rows is not None and trigger_time in self.TRIGGER_LENGTHS:
+            found = self.trigger_rows[int(is_minor), int(trigger_time) - self.TRIGGER_LENGTHS[0], rows].astype(np.int64)
+            missing = found == -2
+            if missing.any():
+                found[missing] = self._search_triggers(rows[missing], trigger_time, is_minor)
+            return found
+        return self._search_triggers(rows, trigger_time, is_minor)
+
+    def _search_triggers(self, rows, trigger_time, is_minor):
+        x = self.times(is_minor)[rows] - trigger_time
+        trigger_rows, suffix_min = self._triggers[is_minor]
+        k = np.searchsorted(suffix_min, x, side='right') - 1
+        found = (k >= 0) & ~np.isnan(x)
+        return np.where(found, trigger_rows[np.maximum(k, 0)] if len(trigger_rows) else -1, -1)
+
+    def successors(self, switch_time: float, trigger_time: float, is_minor: bool = False):
+        """Links every targetable region to the first one that can still be tagged after hitting it.
+
+        That is the first targetable region updating more than switch_time seconds later, whose trigger
+        updates after the region we just hit (so we can switch over before watching it).
+
+        Returns:
+            (rows, triggers, successor): targetable rows that have a trigger, their trigger rows, and for each
+            of them the position in rows of its successor, or len(rows) if there is none.
+        """
+        candidates, target_times, prefix_max, monotonic = self._targets[is_minor]
+        triggers = self.triggers(candidates, trigger_time, is_minor)
+        keep = triggers >= 0
+        rows, triggers, target_times = candidates[keep], triggers[keep], target_times[keep]
+        prefix_max = np.maximum.accumulate(target_times) if len(rows) else target_times
+        n = len(rows)
+
+        # First by time, then first whose trigger comes after us. Both are sorted when update order is.
+        successor = np.searchsorted(prefix_max, target_times + switch_time, side='right')
+        trigger_max = np.maximum.accumulate(triggers) if n else triggers
+        successor = np.maximum(successor, np.searchsorted(trigger_max, rows, side='right'))
+
+        if not monotonic or np.any(np.diff(triggers) < 0):
+            # Out-of-order timestamps: the guess above is a lower bound, walk forward from it where it's wrong
+            for i in np.flatnonzero(successor < n):
+                j = int(successor[i])
+                while j < n and (target_times[j] <= target_times[i] + switch_time or triggers[j] <= rows[i]):
+                    j += 1
+                successor[i] = j
+        return rows, triggers, successor
+
+    def targets(self, row: int, switch_time: float, count: int = 1, is_minor: bool = False) -> np.ndarray:
+        """Gets the rows of the first count targetable regions updating more than switch_time seconds after the given row."""
+        x = self.times(is_minor)[row] + switch_time
+        rows, target_times, prefix_max, monotonic = self._targets[is_minor]
+        if np.isnan(x):
+            return rows[:0]
+        start = int(np.searchsorted(prefix_max, x, side='right'))
+        if monotonic:
+            return rows[start:start + count]
+        return rows[start + np.flatnonzero(target_times[start:] > x)[:count]]
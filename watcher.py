@@ -0,0 +1,226 @@
+import asyncio
+import json
+import re
+import time
+
+import nationstates
+
+# Multiplexed region watching. One engine polls every region we care about (trigger, target, update probes)
+# round-robin on the NS client's loop, spending the ratelimit budget where it matters most right now.
+# With a Stream attached, updates are pushed to us instead and polling drops to a trickle - unless the stream stalls.
+
+
+class Watch:
+    def __init__(self, region, callback, expected=None, baseline=None):
+        self.region = nationstates.nsify(region)
+        self.callback = callback # Called with (region, lastupdate) from the client loop once the region updates
+        self.expected = expected # Unix time we expect it to update, or None if we have no idea (always urgent)
+        self.baseline = baseline # Last update before the one we're waiting for. None: take it from the first poll
+        self.updated = None # Last update time once it has updated
+        self.next = 0.0 # time.monotonic() this region is next due a poll
+
+
+class Watcher:
+    def __init__(self, client=None, reserve=5, hot=60, cold=0.1, fastest=0.05, pushed=0.05):
+        self.client = client or nationstates.client()
+        self.reserve = reserve # Requests per window left alone for everything else - points, verification...
+        self.hot = hot # Seconds either side of a region's expected update during which it polls at full weight
+        self.cold = cold # Poll weight of a region well away from its expected update
+        self.fastest = fastest # Floor on the gap between two polls, in seconds
+        self.pushed = pushed # Share of the normal polling rate kept up while a healthy stream pushes updates to us
+        self.stream = None # Stream feeding us, if any
+
+        self.watches = {} # Region -> Watch. Only ever touched on the client loop
+        self.wake = asyncio.Event()
+        self.task = None
+
+    # Thread-safe interface - everything is handed over to the client loop
+
+    def watch(self, region, callback, expected=None, baseline=None):
+        watch = Watch(region, callback, expected, baseline)
+        self.client.loop.call_soon_threadsafe(self._add, watch)
+        return watch
+
+    def unwatch(self, region):
+        self.client.loop.call_soon_threadsafe(self._remove, nationstates.nsify(region))
+
+    def clear(self):
+        self.client.loop.call_soon_threadsafe(self._clear)
+
+    def attach(self, stream):
+        # Let a Stream push updates to us. It follows whatever we are watching from then on.
+        self.stream = stream
+        self.client.loop.call_soon_threadsafe(stream.follow, list(self.watches))
+
+    # Client loop side
+
+    def _add(self, watch):
+        self.watches[watch.region] = watch
+        if self.task is None or self.task.done():
+            self.task = self.client.loop.create_task(self._run())
+        self.wake.set()
+        self._follow()
+
+    def _remove(self, region):
+        self.watches.pop(region, None)
+        self._follow()
+
+    def _clear(self):
+        self.watches.clear()
+        self._follow()
+
+    def _follow(self):
+        if self.stream:
+            self.stream.follow(list(self.watches))
+
+    def _fire(self, watch, lastupdate):
+        del self.watches[watch.region]
+        watch.updated = lastupdate
+        watch.callback(watch.region, lastupdate)
+        self._follow()
+
+    def rush(self):
+        # Everyone is due a poll right now - e.g. the stream we were leaning on just died. Client loop only.
+        for watch in self.watches.values():
+            watch.next = 0.0
+        self.wake.set()
+
+    def push(self, region, lastupdate):
+        # A stream saw region update. Client loop only.
+        watch = self.watches.get(region)
+        if watch and (watch.baseline is None or lastupdate > watch.baseline):
+            self._fire(watch, lastupdate)
+
+    def weight(self, watch):
+        if watch.expected is None or abs(watch.expected - time.time()) <= self.hot:
+            return 1.0
+        return self.cold
+
+    def interval(self):
+        # Gap between two polls that spreads what's left of the budget evenly over the rest of the window
+        remaining, reset = self.client.ratelimit.budget()
+        spare = remaining - self.reserve
+        if spare <= 0:
+            return max(reset, self.fastest)
+        if self.stream and self.stream.healthy():
+            spare *= self.pushed # Polls are only a safety net while updates are pushed to us
+        return max(reset / spare, self.fastest)
+
+    async def _run(self):
+        while self.watches:
+            now = time.monotonic()
+            watch = min(self.watches.values(), key=lambda w: w.next)
+            if watch.next > now:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), watch.next - now) # New watches cut the wait short
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Each region's share of the polls follows its weight; all of them together poll once per interval
+            total = sum(self.weight(w) for w in self.watches.values())
+            watch.next = now + self.interval() * total / self.weight(watch)
+            self.client.loop.create_task(self._poll(watch))
+
+    async def _poll(self, watch):
+        try:
+            lastupdate = await nationstates.lastupdate(watch.region)
+        except Exception as e:
+            print(f"Failed to poll {watch.region}")
+            print(e)
+            return
+
+        if self.watches.get(watch.region) is not watch: # Unwatched, or replaced, while we were asking
+            return
+        if watch.baseline is None:
+            watch.baseline = lastupdate
+        elif lastupdate > watch.baseline:
+            self._fire(watch, lastupdate)
+
+
+class Stream:
+    # Consumer for the NS server-sent events happenings feed. Connects to the buckets of the regions the watcher follows,
+    # reconnects with backoff when dropped, and reconnects when the followed set changes. Lines that can't be a region
+    # update are thrown away as raw bytes, before any decoding.
+
+    UPDATED = re.compile(r"%%([a-z0-9_\-]+)%% updated")
+
+    def __init__(self, watcher, base=None, stall=30, backoff=30):
+        self.watcher = watcher
+        self.client = watcher.client
+        self.base = base or f"{nationstates.BASE}/api/" # SSE endpoint, buckets are appended: base + "region:a+region:b"
+        self.stall = stall # Seconds without so much as a keepalive before we call the stream dead
+        self.backoff = backoff # Longest wait between reconnection attempts
+        self.regions = []
+        self.alive = False # Connected and hearing from the server
+        self.task = None
+
+    def healthy(self):
+        return self.alive
+
+    def follow(self, regions):
+        # Client loop only. (Re)connect for the given regions, or hang up if there are none.
+        regions = sorted(regions)
+        if regions == self.regions and self.task and not self.task.done():
+            return
+        self.regions = regions
+        if self.task:
+            self.task.cancel()
+        self.alive = False
+        self.task = self.client.loop.create_task(self._run()) if regions else None
+
+    def stop(self):
+        self.client.loop.call_soon_threadsafe(self.follow, [])
+
+    def current(self):
+        # Whether the running task is still the one we want. wait_for can swallow the cancel follow() sends when a line
+        # comes in at the same moment, which would leave the old stream reading - and holding a connection - forever.
+        return asyncio.current_task() is self.task
+
+    def url(self):
+        return self.base + "+".join(f"region:{region}" for region in self.regions)
+
+    async def _run(self):
+        delay = 1
+        while self.current():
+            try:
+                r = await self.client.stream(self.url(), headers={**self.client.headers, "Accept": "text/event-stream"})
+                try:
+                    delay = 1
+                    self.alive = self.current()
+                    await self._read(r)
+                finally:
+                    if self.current(): # A stale task must not mark its replacement dead
+                        self.alive = False
+                    r.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Happenings stream dropped: {e!r}")
+            if not self.current():
+                return
+            self.watcher.rush() # Nobody is pushing anything to us until we're back
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.backoff)
+
+    async def _read(self, r):
+        while self.current():
+            try:
+                line = await asyncio.wait_for(r.content.readline(), self.stall)
+            except asyncio.TimeoutError:
+                print("Happenings stream stalled, falling back to polling")
+                return
+            if not line: # Server hung up
+                return
+
+            # Keepalives count too, we only care that the pipe is open
+            if not line.startswith(b"data:") or b" updated" not in line:
+                continue
+            try:
+                event = json.loads(line[5:])
+            except ValueError:
+                continue
+            match = self.UPDATED.search(event.get("str", ""))
+            if match:
+                self.watcher.push(match.group(1), int(event.get("time") or time.time()))